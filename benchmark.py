@@ -0,0 +1,386 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+import torch
+import torchvision
+from torch.profiler import profile, ProfilerActivity
+
+from src import PreTaskEncoder, KobeModel, YoloLoss, ENCODER_HIDDEN, NUM_CLASSES, S, B
+from src import yolo_collate_fn, pred_decode_batch, batched_class_nms, target_encode_batch, transform_target
+from data_helper import LabeledDataset, image_names, seed_worker
+from helper import compute_ats_bounding_boxes, compute_ts_road_map, compute_iou_pairs
+
+
+def per_camera_encode(encoder, x):
+    # how KobeModel used to encode: one encoder call per camera
+    return torch.cat([encoder(x[:, i, :]) for i in range(x.size(1))], dim = 1)
+
+
+def folded_encode(encoder, x):
+    # cameras folded into the batch, as in KobeModel.encode_cameras
+    n_batch, t = x.shape[:2]
+    x_enc = encoder(x.reshape(n_batch * t, *x.shape[2:]))
+
+    return x_enc.view(n_batch, t * ENCODER_HIDDEN)
+
+
+def time_calls(fn, repeats, warmup, sync=None):
+    # all the timings of fn, in seconds
+    for _ in range(warmup):
+        fn()
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        if sync is not None:
+            sync()
+        timings.append(time.perf_counter() - start)
+
+    return np.array(timings)
+
+
+def time_call(fn, repeats, warmup):
+    return np.median(time_calls(fn, repeats, warmup))
+
+
+def bench_encoder(batch_sizes, repeats, warmup):
+    encoder = PreTaskEncoder(6)
+    encoder.eval()
+
+    print(f'{"batch":>5} {"per camera (ms)":>16} {"folded (ms)":>12} '
+          f'{"samples/s before":>17} {"samples/s after":>16} {"speedup":>8}')
+
+    for batch_size in batch_sizes:
+        x = torch.rand(batch_size, 6, 3, 256, 306)
+
+        with torch.no_grad():
+            before = time_call(lambda: per_camera_encode(encoder, x), repeats, warmup)
+            after = time_call(lambda: folded_encode(encoder, x), repeats, warmup)
+
+        print(f'{batch_size:>5} {1000 * before:>16.1f} {1000 * after:>12.1f} '
+              f'{batch_size / before:>17.1f} {batch_size / after:>16.1f} {before / after:>7.2f}x')
+
+
+def make_synthetic_data(image_folder, scene_id, num_samples, seed=0):
+    # a scene of random camera JPEGs and road maps, with a few boxes per sample
+    rng = np.random.RandomState(seed)
+    annotations = []
+
+    for sample_id in range(num_samples):
+        sample_path = os.path.join(image_folder, f'scene_{scene_id}', f'sample_{sample_id}')
+        os.makedirs(sample_path, exist_ok=True)
+
+        for image_name in image_names:
+            image = rng.randint(0, 256, size=(256, 306, 3), dtype=np.uint8)
+            Image.fromarray(image).save(os.path.join(sample_path, image_name))
+
+        ego_image = np.full((800, 800, 3), 255, dtype=np.uint8)
+        ego_image[rng.randint(800):, :400] = 100
+        Image.fromarray(ego_image).save(os.path.join(sample_path, 'ego.png'))
+
+        for _ in range(rng.randint(1, 8)):
+            x, y = rng.uniform(-35, 35, size=2)
+            w, h = rng.uniform(1, 4, size=2)
+            annotations.append({'scene': scene_id, 'sample': sample_id,
+                                'fl_x': x + w, 'fr_x': x + w, 'bl_x': x - w, 'br_x': x - w,
+                                'fl_y': y + h, 'fr_y': y - h, 'bl_y': y + h, 'br_y': y - h,
+                                'category_id': rng.randint(10), 'action_id': rng.randint(5)})
+
+    annotation_file = os.path.join(image_folder, 'annotation.csv')
+    pd.DataFrame(annotations).to_csv(annotation_file, index=False)
+
+    return annotation_file
+
+
+def bench_loader(num_samples, decode_threads, num_workers, batch_size):
+    with tempfile.TemporaryDirectory() as image_folder:
+        annotation_file = make_synthetic_data(image_folder, 0, num_samples)
+
+        print(f'{"decode threads":>14} {"workers":>7} {"samples/s":>10}')
+
+        for threads in decode_threads:
+            for workers in num_workers:
+                dataset = LabeledDataset(image_folder=image_folder,
+                                         annotation_file=annotation_file,
+                                         scene_index=np.array([0]),
+                                         transform=torchvision.transforms.ToTensor(),
+                                         extra_info=False,
+                                         decode_threads=threads)
+                # the synthetic scene is shorter than a real one
+                dataset = torch.utils.data.Subset(dataset, range(num_samples))
+                loader = torch.utils.data.DataLoader(dataset,
+                                                     batch_size=batch_size,
+                                                     num_workers=workers,
+                                                     collate_fn=yolo_collate_fn,
+                                                     worker_init_fn=seed_worker)
+
+                start = time.perf_counter()
+                for _ in loader:
+                    pass
+                elapsed = time.perf_counter() - start
+
+                print(f'{threads:>14} {workers:>7} {num_samples / elapsed:>10.1f}')
+
+
+def bench_backends(model_file, onnx_file, batch_sizes, repeats, warmup):
+    # the same ModelLoader calls through eager torch and through onnxruntime, on the cpu
+    from model_loader import ModelLoader
+
+    torch_loader = ModelLoader(model_file=model_file)
+    torch_loader.model.to('cpu')
+    torch_loader.device = 'cpu'
+    onnx_loader = ModelLoader(backend='onnx', onnx_file=onnx_file)
+
+    print(f'{"batch":>5} {"torch (ms)":>11} {"onnx (ms)":>10} {"speedup":>8}')
+
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            samples = torch.rand(batch_size, 6, 3, 256, 306)
+
+            before = time_call(lambda: torch_loader.get_bounding_boxes_and_road_map(samples), repeats, warmup)
+            after = time_call(lambda: onnx_loader.get_bounding_boxes_and_road_map(samples), repeats, warmup)
+
+            print(f'{batch_size:>5} {1000 * before:>11.1f} {1000 * after:>10.1f} {before / after:>7.2f}x')
+
+
+def allocated_bytes(fn, device):
+    # bytes allocated by the ops of one call of fn, frees are not subtracted
+    activities = [ProfilerActivity.CPU]
+    if device.type == 'cuda':
+        activities.append(ProfilerActivity.CUDA)
+
+    with profile(activities=activities, profile_memory=True) as prof:
+        fn()
+
+    events = prof.key_averages()
+    cpu_bytes = sum(max(event.self_cpu_memory_usage, 0) for event in events)
+    device_bytes = sum(max(getattr(event, 'self_device_memory_usage', 0), 0) for event in events)
+
+    return int(cpu_bytes), int(device_bytes)
+
+
+def random_target(rng, num_boxes, rotated=False):
+    # a LabeledDataset target with num_boxes boxes inside the 80m x 80m grid, axis aligned
+    # unless rotated, which turns every box by a random angle around its center
+    x, y = rng.uniform(-35, 35, size=(2, num_boxes, 1))
+    w, h = rng.uniform(1, 4, size=(2, num_boxes, 1))
+    dx = np.concatenate([w, w, -w, -w], 1)
+    dy = np.concatenate([h, -h, h, -h], 1)
+    if rotated:
+        angle = rng.uniform(0, np.pi, size=(num_boxes, 1))
+        dx, dy = dx * np.cos(angle) - dy * np.sin(angle), dx * np.sin(angle) + dy * np.cos(angle)
+    bounding_box = np.stack([x + dx, y + dy], 1)
+
+    return {'bounding_box': torch.from_numpy(bounding_box).double(),
+            'category': torch.from_numpy(rng.randint(NUM_CLASSES, size=num_boxes))}
+
+
+def suite_cases(model_batch_sizes, device, image_folder, seed=0):
+    """
+    Returns a list of (name, fn) with the synthetic inputs built from a fixed seed.
+    image_folder is a scratch directory for the LabeledDataset case.
+    """
+    rng = np.random.RandomState(seed)
+    torch.manual_seed(seed)
+    cases = []
+
+    # detection post processing, the batched functions KobeModel and the inference graph call
+    pred_tensor = torch.rand(4, S, S, 5 * B + NUM_CLASSES, device=device)
+    cases.append(('pred_decode_batch', lambda: pred_decode_batch(pred_tensor)))
+
+    # 4 samples of 50 boxes
+    xy = torch.rand(200, 2, device=device)
+    boxes = torch.cat([xy, xy + 0.1 * torch.rand(200, 2, device=device)], 1)
+    scores = torch.rand(200, device=device)
+    labels = torch.randint(NUM_CLASSES, (200,), device=device)
+    offsets = torch.arange(0, 201, 50, device=device)
+    cases.append(('batched_class_nms', lambda: batched_class_nms(boxes, scores, labels, offsets, NUM_CLASSES)))
+
+    # targets, 8 samples of 1 to 20 boxes
+    targets = tuple(random_target(rng, rng.randint(1, 20)) for _ in range(8))
+    xy = torch.from_numpy(rng.uniform(0, 0.9, size=(80, 2))).float()
+    encode_boxes = torch.cat([xy, xy + 0.05], 1)
+    encode_labels = torch.from_numpy(rng.randint(NUM_CLASSES, size=80))
+    encode_samples = torch.from_numpy(np.sort(rng.randint(8, size=80)))
+    cases.append(('target_encode_batch', lambda: target_encode_batch(encode_boxes, encode_labels, encode_samples, 8)))
+    cases.append(('transform_target', lambda: transform_target(targets)))
+
+    # loss, forward only
+    yolo_loss = YoloLoss(feature_size=S, num_bboxes=B, num_classes=NUM_CLASSES).to(device)
+    loss_pred = torch.rand(8, S, S, 5 * B + NUM_CLASSES, device=device)
+    loss_target = transform_target(targets).to(device)
+    cases.append(('yolo_loss', lambda: yolo_loss(loss_pred, loss_target)))
+
+    # the model, inference at several batch sizes
+    kobe_model = KobeModel(num_classes=NUM_CLASSES, encoder_features=6, rm_dim=800).to(device)
+    kobe_model.eval()
+    for batch_size in model_batch_sizes:
+        x = torch.rand(batch_size, 6, 3, 256, 306, device=device)
+        cases.append((f'kobe_forward_b{batch_size}', lambda x=x: kobe_model(x)))
+
+    # scoring
+    predicted = random_target(rng, 10)['bounding_box']
+    target = random_target(rng, 10)['bounding_box']
+    cases.append(('compute_ats_bounding_boxes', lambda: compute_ats_bounding_boxes(predicted, target)))
+
+    # 200 overlapping pairs, axis aligned ones take the rectangle fast path, rotated ones the convex hull path
+    for rotated in [False, True]:
+        boxes1 = random_target(rng, 200, rotated=rotated)['bounding_box']
+        boxes2 = random_target(rng, 200, rotated=rotated)['bounding_box']
+        # moved next to boxes1 so that every pair overlaps
+        shift = torch.from_numpy(rng.uniform(-1, 1, size=(200, 2, 1)))
+        boxes2 = boxes2 - boxes2.mean(2, keepdim=True) + boxes1.mean(2, keepdim=True) + shift
+        cases.append((f'compute_iou_pairs_{"rotated" if rotated else "aligned"}',
+                      lambda boxes1=boxes1, boxes2=boxes2: compute_iou_pairs(boxes1, boxes2)))
+
+    road_map1 = torch.from_numpy(rng.rand(800, 800) > 0.5)
+    road_map2 = torch.from_numpy(rng.rand(800, 800) > 0.5)
+    cases.append(('compute_ts_road_map', lambda: compute_ts_road_map(road_map1, road_map2)))
+
+    # data loading on synthetic JPEGs
+    annotation_file = make_synthetic_data(image_folder, 0, 8, seed=seed)
+    dataset = LabeledDataset(image_folder=image_folder,
+                             annotation_file=annotation_file,
+                             scene_index=np.array([0]),
+                             transform=torchvision.transforms.ToTensor(),
+                             extra_info=False)
+    # one item per call, like the other cases the time is per call
+    cases.append(('labeled_dataset_getitem', lambda: dataset[0]))
+
+    return cases
+
+
+def run_suite(model_batch_sizes, repeats, warmup, device, cases=None):
+    device = torch.device(device)
+    sync = torch.cuda.synchronize if device.type == 'cuda' else None
+
+    results = {}
+    with tempfile.TemporaryDirectory() as image_folder:
+        with torch.no_grad():
+            for name, fn in suite_cases(model_batch_sizes, device, image_folder):
+                if cases and name not in cases:
+                    continue
+
+                timings = time_calls(fn, repeats, warmup, sync)
+                cpu_bytes, device_bytes = allocated_bytes(fn, device)
+                results[name] = {'min_ms': 1000 * float(timings.min()),
+                                 'median_ms': 1000 * float(np.median(timings)),
+                                 'p95_ms': 1000 * float(np.percentile(timings, 95)),
+                                 'cpu_alloc_bytes': cpu_bytes,
+                                 'device_alloc_bytes': device_bytes,
+                                 'repeats': repeats,
+                                 }
+
+                print(f'{name:>28} {results[name]["median_ms"]:>10.3f} {results[name]["p95_ms"]:>10.3f} '
+                      f'{cpu_bytes / 2 ** 20:>10.2f}')
+
+    return {'environment': {'torch': torch.__version__,
+                            'python': platform.python_version(),
+                            'machine': platform.machine(),
+                            'threads': torch.get_num_threads(),
+                            'device': str(device),
+                            },
+            'results': results,
+            }
+
+
+def compare_to_baseline(report, baseline, threshold):
+    # names of the cases whose fastest call is more than threshold slower than in the baseline,
+    # the fastest call is the least disturbed by the rest of the machine
+    # timings of another machine, torch or thread count say nothing about a regression
+    mismatches = [f'{key} {value} instead of {report["environment"].get(key)}'
+                  for key, value in baseline['environment'].items() if report['environment'].get(key) != value]
+    if mismatches:
+        raise ValueError(f'the baseline was measured with {", ".join(mismatches)}, record one here with --json')
+
+    regressions = []
+    for name, result in report['results'].items():
+        if name not in baseline['results']:
+            continue
+
+        before = baseline['results'][name]['min_ms']
+        ratio = result['min_ms'] / before
+        print(f'{name:>28} {before:>10.3f} {result["min_ms"]:>10.3f} {ratio:>7.2f}x'
+              f'{"  REGRESSION" if ratio > 1 + threshold else ""}')
+
+        if ratio > 1 + threshold:
+            regressions.append(name)
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--repeats', type=int, default=None,
+                        help='10 by default, 50 for the suite so that its timings are stable within the threshold')
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--loader', action='store_true',
+                        help='benchmark LabeledDataset loading on synthetic JPEGs instead of the encoder')
+    parser.add_argument('--num_samples', type=int, default=48)
+    parser.add_argument('--decode_threads', type=int, nargs='+', default=[0, 6])
+    parser.add_argument('--num_workers', type=int, nargs='+', default=[0, 4])
+    parser.add_argument('--backends', action='store_true',
+                        help='compare the torch and onnx ModelLoader backends')
+    parser.add_argument('--model_file', type=str, default='combined_model.pt')
+    parser.add_argument('--onnx_file', type=str, default='combined_model.onnx',
+                        help='written by onnx_backend.py')
+    parser.add_argument('--suite', action='store_true',
+                        help='benchmark the detection, scoring and data hot paths on synthetic inputs')
+    parser.add_argument('--model_batch_sizes', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--cases', type=str, nargs='+', default=None,
+                        help='only run these suite cases')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--json', type=str, default=None,
+                        help='write the suite results to this file')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='suite results written by --json on this machine to compare against, '
+                             'exits with 1 on a regression. benchmark_baseline.json is one, see its environment')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed slowdown of the fastest call against the baseline')
+    opt = parser.parse_args()
+
+    if opt.threads is not None:
+        torch.set_num_threads(opt.threads)
+
+    torch.manual_seed(0)
+
+    repeats = opt.repeats if opt.repeats is not None else 50 if opt.suite else 10
+
+    print(f'torch {torch.__version__}, {torch.get_num_threads()} threads')
+    if opt.backends:
+        bench_backends(opt.model_file, opt.onnx_file, opt.batch_sizes, repeats, opt.warmup)
+    elif opt.suite:
+        print(f'{"case":>28} {"median ms":>10} {"p95 ms":>10} {"alloc MB":>10}')
+        report = run_suite(opt.model_batch_sizes, repeats, opt.warmup, opt.device, opt.cases)
+
+        if opt.json is not None:
+            with open(opt.json, 'w') as f:
+                json.dump(report, f, indent=2)
+
+        if opt.baseline is not None:
+            with open(opt.baseline) as f:
+                baseline = json.load(f)
+
+            print(f'{"case":>28} {"baseline":>10} {"min ms":>10} {"ratio":>8}')
+            regressions = compare_to_baseline(report, baseline, opt.threshold)
+            if regressions:
+                print(f'Regressions over {opt.threshold:.0%}: {", ".join(regressions)}')
+                sys.exit(1)
+    elif opt.loader:
+        bench_loader(opt.num_samples, opt.decode_threads, opt.num_workers, batch_size=8)
+    else:
+        bench_encoder(opt.batch_sizes, repeats, opt.warmup)
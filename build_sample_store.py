@@ -0,0 +1,104 @@
+#! /usr/bin/env python3
+
+# Converts the scenes of the image folder to a sample store: per scene, the
+# decoded camera images as a uint8 [NUM_SAMPLE_PER_SCENE, 6, 3, H, W] array and,
+# for labeled scenes, the road maps bit-packed along their width. Both are .npy
+# files that StoreLabeledDataset and StoreUnlabeledDataset memory-map.
+
+import os
+import json
+import argparse
+
+import numpy as np
+from PIL import Image
+
+import torchvision
+
+from data_helper import NUM_SAMPLE_PER_SCENE, NUM_IMAGE_PER_SAMPLE, image_names
+from data_helper import STORE_MANIFEST, STORE_VERSION, write_array
+from helper import convert_map_to_road_map
+
+
+def decode_image(image_path):
+    # HWC uint8 -> CHW, the layout ToTensor returns
+    with Image.open(image_path) as image:
+        return np.asarray(image).transpose(2, 0, 1)
+
+
+def decode_road_map(ego_path):
+    with Image.open(ego_path) as ego_image:
+        ego_image = torchvision.transforms.functional.to_tensor(ego_image)
+
+    return convert_map_to_road_map(ego_image).numpy()
+
+
+def convert_scene(image_folder, store_folder, scene_id, manifest):
+    scene_path = os.path.join(image_folder, f'scene_{scene_id}')
+    sample_paths = [os.path.join(scene_path, f'sample_{sample_id}') for sample_id in range(NUM_SAMPLE_PER_SCENE)]
+    os.makedirs(os.path.join(store_folder, f'scene_{scene_id}'), exist_ok=True)
+
+    image_shape = decode_image(os.path.join(sample_paths[0], image_names[0])).shape
+    images = os.path.join(f'scene_{scene_id}', 'images.npy')
+    write_array(os.path.join(store_folder, images),
+                (NUM_SAMPLE_PER_SCENE, NUM_IMAGE_PER_SAMPLE) + image_shape,
+                np.uint8,
+                (np.stack([decode_image(os.path.join(sample_path, image_name)) for image_name in image_names])
+                 for sample_path in sample_paths))
+
+    road_maps = None
+    if os.path.exists(os.path.join(sample_paths[0], 'ego.png')):
+        road_map_shape = decode_road_map(os.path.join(sample_paths[0], 'ego.png')).shape
+        road_maps = os.path.join(f'scene_{scene_id}', 'road_maps.npy')
+        write_array(os.path.join(store_folder, road_maps),
+                    (NUM_SAMPLE_PER_SCENE, road_map_shape[0], (road_map_shape[1] + 7) // 8),
+                    np.uint8,
+                    (np.packbits(decode_road_map(os.path.join(sample_path, 'ego.png')), axis=-1)
+                     for sample_path in sample_paths))
+        manifest['road_map_shape'] = list(road_map_shape)
+
+    manifest['image_shape'] = list(image_shape)
+    manifest['scenes'][str(scene_id)] = {'images': images, 'road_maps': road_maps}
+
+
+def build_sample_store(image_folder, store_folder, scene_index, verbose=False):
+    os.makedirs(store_folder, exist_ok=True)
+
+    manifest_path = os.path.join(store_folder, STORE_MANIFEST)
+    if os.path.exists(manifest_path):
+        # add scenes to an existing store
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['version'] != STORE_VERSION:
+            raise ValueError(f'{store_folder} has sample store version {manifest["version"]}, '
+                             f'expected {STORE_VERSION}')
+    else:
+        manifest = {'version': STORE_VERSION,
+                    'image_names': image_names,
+                    'scenes': {},
+                    }
+
+    for scene_id in scene_index:
+        convert_scene(image_folder, store_folder, scene_id, manifest)
+
+        # the manifest is rewritten after each scene so that a partial conversion is usable
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+        if verbose:
+            print(f'scene {scene_id} done')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default='data')
+    parser.add_argument('--store_dir', type=str, default='data_store')
+    parser.add_argument('--first_scene', type=int, default=0)
+    parser.add_argument('--last_scene', type=int, default=147)
+    parser.add_argument('--verbose', action='store_true')
+    opt = parser.parse_args()
+
+    scene_index = [scene_id for scene_id in range(opt.first_scene, opt.last_scene + 1)
+                   if os.path.isdir(os.path.join(opt.data_dir, f'scene_{scene_id}'))]
+
+    build_sample_store(opt.data_dir, opt.store_dir, scene_index, verbose=opt.verbose)
@@ -0,0 +1,77 @@
+#! /usr/bin/env python3
+
+# Parity of the scripted and frozen inference graph (and optionally torch.compile)
+# against the eager KobeModel, on random inputs.
+
+import os
+import argparse
+import tempfile
+
+import torch
+
+from model_loader import ModelLoader
+from inference_graph import KobeInference, split_boxes
+
+
+def compare(name, expected, actual, atol):
+    # expected and actual are (per sample boxes, binary road map)
+    expected_boxes, expected_road_map = expected
+    boxes, road_map = actual
+
+    same_counts = [box.shape for box in expected_boxes] == [box.shape for box in boxes]
+    boxes_error = max([(box - expected_box).abs().max().item()
+                       for box, expected_box in zip(boxes, expected_boxes) if box.numel() > 0] + [0.0])
+    road_map_agreement = (road_map == expected_road_map).float().mean().item()
+
+    ok = same_counts and boxes_error <= atol and road_map_agreement == 1.0
+    print(f'{name:>10} same box counts: {same_counts}, max box error: {boxes_error:.2e}, '
+          f'road map agreement: {road_map_agreement:.6f} {"OK" if ok else "MISMATCH"}')
+
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filename', type=str, default='combined_model.pt')
+    parser.add_argument('--batch_norm', action='store_true')
+    parser.add_argument('--shared_decoder', action='store_true')
+    parser.add_argument('--no_fuse_heads', action='store_true')
+    parser.add_argument('--quantize', action='store_true')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 3])
+    parser.add_argument('--atol', type=float, default=1e-4,
+                        help='allowed corner difference in meters')
+    parser.add_argument('--compile', action='store_true',
+                        help='also check torch.compile of the inference module')
+    opt = parser.parse_args()
+
+    torch.manual_seed(0)
+
+    model_loader = ModelLoader(model_file=opt.filename,
+                               batch_norm=opt.batch_norm,
+                               shared_decoder=opt.shared_decoder,
+                               quantize=opt.quantize,
+                               fuse_heads=not opt.no_fuse_heads)
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'frozen_model.pt')
+        model_loader.save_frozen(path)
+        frozen_loader = ModelLoader(frozen_file=path)
+
+        compiled = None
+        if opt.compile:
+            compiled = torch.compile(KobeInference(model_loader.model))
+
+        ok = True
+        with torch.no_grad():
+            for batch_size in opt.batch_sizes:
+                samples = torch.rand(batch_size, 6, 3, 256, 306)
+                print(f'batch size {batch_size}')
+
+                expected = model_loader.get_bounding_boxes_and_road_map(samples)
+                ok &= compare('frozen', expected, frozen_loader.get_bounding_boxes_and_road_map(samples), opt.atol)
+
+                if compiled is not None:
+                    boxes, counts, road_map = compiled(samples.to(model_loader.device))
+                    ok &= compare('compiled', expected, (split_boxes(boxes, counts), road_map > 0.5), opt.atol)
+
+    print('PARITY OK' if ok else 'PARITY FAILED')
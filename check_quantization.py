@@ -0,0 +1,126 @@
+#! /usr/bin/env python3
+
+# Accuracy and speed of the int8 heads (ModelLoader(quantize=True)) against the fp32 model.
+# Dynamic quantization computes the activation scales on the fly, so there is no
+# calibration pass: the check is the validation scores of both models.
+
+import io
+import time
+import random
+import argparse
+
+import numpy as np
+
+import torch
+
+from data_helper import LabeledDataset, StoreLabeledDataset, seed_worker
+from evaluation import collate_fn_eval, evaluate
+from model_loader import get_transform_task1, ModelLoader
+
+
+def model_bytes(model):
+    # size of the serialized state_dict, quantized weights included
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+
+    return buffer.tell()
+
+
+def forward_time(model_loader, samples, repeats):
+    with torch.no_grad():
+        model_loader.get_bounding_boxes_and_road_map(samples)
+
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model_loader.get_bounding_boxes_and_road_map(samples)
+            timings.append(time.perf_counter() - start)
+
+    return np.median(timings)
+
+
+def check(opt, dataloader, samples, quantize):
+    model_loader = ModelLoader(model_file=opt.filename,
+                               prob_thresh=opt.prob_thresh,
+                               conf_thresh=opt.conf_thresh,
+                               nms_thresh=opt.nms_thresh,
+                               batch_norm=opt.batch_norm,
+                               shared_decoder=opt.shared_decoder,
+                               quantize=quantize,
+                               quantize_shared_decoder=opt.quantize_shared_decoder)
+    # the fp32 model runs on the cpu too, the comparison is about cpu inference
+    model_loader.model.to('cpu')
+    model_loader.device = 'cpu'
+
+    ats_bounding_boxes, ts_road_map = evaluate(model_loader, dataloader)
+
+    return {'ats_bounding_boxes': float(ats_bounding_boxes),
+            'ts_road_map': float(ts_road_map),
+            'forward_time': forward_time(model_loader, samples, opt.repeats),
+            'model_bytes': model_bytes(model_loader.model),
+            }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default='data')
+    parser.add_argument('--sample_store', type=str, default=None,
+                        help='read the images and road maps from this sample store, see build_sample_store.py')
+    parser.add_argument('--filename', type=str, default='combined_model.pt')
+    parser.add_argument('--first_scene', type=int, default=120)
+    parser.add_argument('--last_scene', type=int, default=133)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--repeats', type=int, default=10,
+                        help='timed forwards of the first batch')
+    parser.add_argument('--prob_thresh', type=float, default=0.1)
+    parser.add_argument('--conf_thresh', type=float, default=0.1)
+    parser.add_argument('--nms_thresh', type=float, default=0.4)
+    parser.add_argument('--batch_norm', action='store_true')
+    parser.add_argument('--shared_decoder', action='store_true')
+    parser.add_argument('--quantize_shared_decoder', action='store_true')
+    opt = parser.parse_args()
+
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+
+    annotation_csv = f'{opt.data_dir}/annotation.csv'
+    labeled_scene_index = np.arange(opt.first_scene, opt.last_scene + 1)
+
+    if opt.sample_store is not None:
+        # pre-decoded, the annotations still come from the data folder
+        labeled_trainset = StoreLabeledDataset(
+            store_folder=opt.sample_store,
+            annotation_file=annotation_csv,
+            scene_index=labeled_scene_index
+            )
+    else:
+        labeled_trainset = LabeledDataset(
+            image_folder=opt.data_dir,
+            annotation_file=annotation_csv,
+            scene_index=labeled_scene_index,
+            transform=get_transform_task1(),
+            extra_info=False
+            )
+    dataloader = torch.utils.data.DataLoader(
+        labeled_trainset,
+        batch_size=opt.batch_size,
+        shuffle=False,
+        num_workers=opt.num_workers,
+        collate_fn=collate_fn_eval,
+        worker_init_fn=seed_worker
+        )
+    samples = next(iter(dataloader))[0]
+
+    # one model at a time, they are large
+    fp32 = check(opt, dataloader, samples, quantize=False)
+    int8 = check(opt, dataloader, samples, quantize=True)
+
+    print(f'{"":>20} {"fp32":>10} {"int8":>10} {"delta":>10}')
+    for key, name in [('ats_bounding_boxes', 'Bounding Box Score'), ('ts_road_map', 'Road Map Score')]:
+        print(f'{name:>20} {fp32[key]:>10.4f} {int8[key]:>10.4f} {int8[key] - fp32[key]:>+10.4f}')
+    print(f'{"forward ms":>20} {1000 * fp32["forward_time"]:>10.1f} {1000 * int8["forward_time"]:>10.1f} '
+          f'{fp32["forward_time"] / int8["forward_time"]:>9.2f}x')
+    print(f'{"model MB":>20} {fp32["model_bytes"] / 2 ** 20:>10.1f} {int8["model_bytes"] / 2 ** 20:>10.1f} '
+          f'{fp32["model_bytes"] / int8["model_bytes"]:>9.2f}x')
@@ -0,0 +1,218 @@
+# Background checkpointing: the state is snapshotted to cpu memory on the
+# training thread, then serialized on a worker thread and committed atomically
+# (temporary file, then rename) so that a crash never leaves a partial file.
+# Training states add the optimizer, the position in the epoch and the RNGs
+# to the weights, so that training restarts from the exact batch.
+
+import os
+import re
+import queue
+import random
+import threading
+import collections
+
+import numpy as np
+
+import torch
+
+from prefetch import apply_to_tensors
+
+
+def snapshot(state):
+    # cpu copies of every tensor, training can go on changing the originals
+    return apply_to_tensors(state, lambda tensor: tensor.detach().to('cpu', copy=True))
+
+
+def atomic_save(state, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+
+    # the rename itself is only durable once the directory is synced
+    directory = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+def find_checkpoints(pattern):
+    """
+    The existing files matching pattern, a path where {} stands for the step or epoch
+    number, e.g. 'kobe_model_{}_epochs.pt', sorted by that number.
+    """
+    directory, filename = os.path.split(pattern)
+    regex = re.compile(r'(\d+)'.join(re.escape(part) for part in filename.split('{}')))
+
+    found = []
+    for name in os.listdir(directory or '.'):
+        match = regex.fullmatch(name)
+        if match is not None:
+            found.append((int(match.group(1)), os.path.join(directory, name)))
+
+    return [path for _, path in sorted(found)]
+
+
+_STOP = object()
+
+
+class CheckpointWriter():
+    def __init__(self, keep_last=3, max_pending=1, patterns=None):
+        """
+        Args:
+            keep_last (int): how many checkpoints of each tag are kept, older ones are removed
+                once a newer one is committed. None keeps all of them
+            max_pending (int): how many snapshots can wait for the worker, save blocks beyond that
+            patterns (dict): the filename pattern of each tag, see find_checkpoints. The checkpoints
+                already on disk, e.g. from before a restart, count towards keep_last
+        """
+
+        self.keep_last = keep_last
+        self.saved = collections.defaultdict(list)
+        for tag, pattern in (patterns or {}).items():
+            self.saved[tag] = find_checkpoints(pattern)
+
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.worker = threading.Thread(target=self._worker, daemon=True)
+        self.worker.start()
+
+    def save(self, state, path, tag=None):
+        """
+        Snapshots state (nested dicts, lists and tuples of tensors) and writes it to path in the background.
+        Checkpoints with the same tag share the keep_last retention, e.g. 'epoch' and 'step'.
+        """
+        self._raise_error()
+        self.pending.put((snapshot(state), path, tag))
+
+    def wait(self):
+        # blocks until every snapshot so far is committed
+        self.pending.join()
+        self._raise_error()
+
+    def close(self):
+        self.pending.put(_STOP)
+        self.worker.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+
+        # an exception is already propagating, a writer error must not replace it
+        self.pending.put(_STOP)
+        self.worker.join()
+        if self.error is not None:
+            print(f'Checkpoint writer error while handling another exception: {self.error!r}')
+            self.error = None
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _worker(self):
+        while True:
+            item = self.pending.get()
+            try:
+                if item is _STOP:
+                    return
+
+                state, path, tag = item
+                atomic_save(state, path)
+                self._retain(path, tag)
+            except Exception as exception:
+                self.error = exception
+            finally:
+                self.pending.task_done()
+
+    def _retain(self, path, tag):
+        saved = self.saved[tag]
+        if path in saved:
+            saved.remove(path)
+        saved.append(path)
+
+        while self.keep_last is not None and len(saved) > self.keep_last:
+            try:
+                os.remove(saved.pop(0))
+            except FileNotFoundError:
+                pass
+
+
+# version 1 kept the frozen parameters in a separate file shared by the states
+TRAINING_STATE_VERSION = 2
+
+
+def capture_rng_state():
+    # only tensors, ints and tuples, so that the state loads with weights_only
+    numpy_state = np.random.get_state()
+
+    return {'python': random.getstate(),
+            'numpy': (numpy_state[0], torch.from_numpy(numpy_state[1].astype(np.int64))) + tuple(numpy_state[2:]),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+            }
+
+
+def restore_rng_state(rng_state):
+    python_state = rng_state['python']
+    random.setstate((python_state[0], tuple(python_state[1]), python_state[2]))
+
+    numpy_state = rng_state['numpy']
+    np.random.set_state((numpy_state[0], numpy_state[1].numpy().astype(np.uint32)) + tuple(numpy_state[2:]))
+
+    torch.set_rng_state(rng_state['torch'])
+    if torch.cuda.is_available() and len(rng_state['cuda']) > 0:
+        torch.cuda.set_rng_state_all(rng_state['cuda'])
+
+
+class TrainingCheckpointer():
+    def __init__(self, writer, kobe_model, optimizer, sampler):
+        """
+        Saves full training states, the whole model included, through a CheckpointWriter.
+        Args:
+            writer (CheckpointWriter): writes the states in the background
+            sampler (ResumableSampler): the sampler of the training loader
+        """
+
+        self.writer = writer
+        self.kobe_model = kobe_model
+        self.optimizer = optimizer
+        self.sampler = sampler
+
+    def save(self, path, epoch, step, tag=None):
+        # step is the number of optimizer steps done in the epoch
+        state = {'version': TRAINING_STATE_VERSION,
+                 'model': self.kobe_model.state_dict(),
+                 'optimizer': self.optimizer.state_dict(),
+                 'epoch': epoch,
+                 'step': step,
+                 'sampler': self.sampler.state_dict(),
+                 'rng': capture_rng_state(),
+                 }
+        self.writer.save(state, path, tag=tag)
+
+
+def load_training_state(path, kobe_model, optimizer, sampler, map_location='cpu'):
+    """
+    Restores the model, optimizer, sampler and RNGs saved by TrainingCheckpointer.
+    Returns (epoch, step), the epoch to continue and the optimizer steps already done in it.
+    """
+    state = torch.load(path, map_location=map_location)
+    if state.get('version') != TRAINING_STATE_VERSION:
+        raise ValueError(f'{path} is not a training state of version {TRAINING_STATE_VERSION}')
+
+    kobe_model.load_state_dict(state['model'])
+    optimizer.load_state_dict(state['optimizer'])
+    sampler.load_state_dict(state['sampler'])
+    restore_rng_state(state['rng'])
+
+    return state['epoch'], state['step']
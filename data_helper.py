@@ -1,4 +1,7 @@
 import os
+import json
+import random
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 
 import numpy as np
@@ -21,10 +24,132 @@ image_names = [
     'CAM_BACK.jpeg',
     'CAM_BACK_RIGHT.jpeg',
     ]
+corner_columns = ['fl_x', 'fr_x', 'bl_x', 'br_x', 'fl_y', 'fr_y','bl_y', 'br_y']
+
+def build_annotation_index(annotation_dataframe, scene_index):
+    """
+    Args:
+        annotation_dataframe (DataFrame): the annotations, one row per object
+        scene_index (list): the scene indices covered by the dataset
+    Returns:
+        corners: [n_annotations, 8] array of the box corners, grouped by dataset item
+        categories: [n_annotations] array of the object categories
+        actions: [n_annotations] array of the object actions
+        offsets: [len(scene_index) * NUM_SAMPLE_PER_SCENE + 1] array, the annotations
+            of dataset item k are the rows offsets[k]:offsets[k + 1]
+    """
+    num_items = len(scene_index) * NUM_SAMPLE_PER_SCENE
+    scene_position = {scene_id: position for position, scene_id in enumerate(scene_index)}
+
+    position = annotation_dataframe['scene'].map(scene_position)
+    sample = annotation_dataframe['sample']
+    keep = (position.notna() & (sample >= 0) & (sample < NUM_SAMPLE_PER_SCENE)).to_numpy()
+
+    key = position[keep].to_numpy(np.int64) * NUM_SAMPLE_PER_SCENE + sample[keep].to_numpy(np.int64)
+    # a stable sort keeps the annotations of each sample in file order
+    order = np.argsort(key, kind='stable')
+    entries = annotation_dataframe[keep].iloc[order]
+
+    corners = np.ascontiguousarray(entries[corner_columns].to_numpy())
+    categories = entries.category_id.to_numpy()
+    actions = entries.action_id.to_numpy()
+    offsets = np.zeros(num_items + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(key, minlength=num_items))
+
+    return corners, categories, actions, offsets
+
+def seed_worker(worker_id):
+    # DataLoader worker_init_fn: torch is already seeded per worker from the
+    # loader's generator, derive the numpy and random seeds from it
+    worker_seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+# Shuffles like DataLoader(shuffle=True), but the order only depends on (seed, epoch)
+# and an epoch can be resumed part way through.
+class ResumableSampler(torch.utils.data.Sampler):
+    def __init__(self, num_samples, seed=0):
+        """
+        Args:
+            num_samples (int): the length of the dataset
+            seed (int): the order of epoch e is the permutation drawn with seed + e
+        """
+
+        self.num_samples = num_samples
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start = 0
+
+    def skip(self, num_samples):
+        # the current epoch starts after its first num_samples samples
+        self.start = num_samples
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        return iter(torch.randperm(self.num_samples, generator=generator)[self.start:].tolist())
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch, 'start': self.start}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict['seed']
+        self.epoch = state_dict['epoch']
+        self.start = state_dict['start']
+
+_decode_pool = None
+_decode_pool_key = None
+
+def get_decode_pool(decode_threads):
+    # one pool per process, a forked DataLoader worker creates its own
+    global _decode_pool, _decode_pool_key
+
+    if _decode_pool_key != (os.getpid(), decode_threads):
+        # a pool of this process with another thread count, the threads of a parent's pool don't exist here
+        if _decode_pool is not None and _decode_pool_key[0] == os.getpid():
+            _decode_pool.shutdown(wait=False)
+        _decode_pool = ThreadPoolExecutor(max_workers=decode_threads)
+        _decode_pool_key = (os.getpid(), decode_threads)
+
+    return _decode_pool
+
+def default_decode_threads(num_workers):
+    # the cores left to each loader process, more decode threads would only contend for them
+    threads = min((os.cpu_count() or 1) // max(1, num_workers), NUM_IMAGE_PER_SAMPLE)
+
+    return threads if threads > 1 else 0
+
+def to_uint8_tensor(image):
+    # uint8 [3, H, W] view on the decoded image, for the uint8 pipeline: the
+    # conversion to float happens once per batch, in KobeModel.encode_cameras
+    return torch.from_numpy(np.array(image)).permute(2, 0, 1)
+
+def load_image(image_path, transform):
+    with Image.open(image_path) as image:
+        return transform(image)
+
+def load_sample_images(sample_path, transform, decode_threads=0):
+    # PIL releases the GIL while decoding, so the cameras can be decoded on threads
+    image_paths = [os.path.join(sample_path, image_name) for image_name in image_names]
+
+    if decode_threads > 0:
+        images = list(get_decode_pool(decode_threads).map(load_image, image_paths, [transform] * len(image_paths)))
+    else:
+        images = [load_image(image_path, transform) for image_path in image_paths]
+
+    return torch.stack(images)
 
 # The dataset class for unlabeled data.
 class UnlabeledDataset(torch.utils.data.Dataset):
-    def __init__(self, image_folder, scene_index, first_dim, transform):
+    def __init__(self, image_folder, scene_index, first_dim, transform, decode_threads=0):
         """
         Args:
             image_folder (string): the location of the image folder
@@ -39,11 +164,13 @@ class UnlabeledDataset(torch.utils.data.Dataset):
                     CAM_BACK.jpeg: 4
                     CAM_BACK_RIGHT: 5
             transform (Transform): The function to process the image
+            decode_threads (int): decode the cameras of a sample on this many threads, 0 decodes them in turn
         """
 
         self.image_folder = image_folder
         self.scene_index = scene_index
         self.transform = transform
+        self.decode_threads = decode_threads
 
         assert first_dim in ['sample', 'image']
         self.first_dim = first_dim
@@ -60,12 +187,7 @@ class UnlabeledDataset(torch.utils.data.Dataset):
             sample_id = index % NUM_SAMPLE_PER_SCENE
             sample_path = os.path.join(self.image_folder, f'scene_{scene_id}', f'sample_{sample_id}') 
 
-            images = []
-            for image_name in image_names:
-                image_path = os.path.join(sample_path, image_name)
-                image = Image.open(image_path)
-                images.append(self.transform(image))
-            image_tensor = torch.stack(images)
+            image_tensor = load_sample_images(sample_path, self.transform, self.decode_threads)
             
             return image_tensor
 
@@ -76,13 +198,11 @@ class UnlabeledDataset(torch.utils.data.Dataset):
 
             image_path = os.path.join(self.image_folder, f'scene_{scene_id}', f'sample_{sample_id}', image_name) 
             
-            image = Image.open(image_path)
-
-            return self.transform(image), index % NUM_IMAGE_PER_SAMPLE
+            return load_image(image_path, self.transform), index % NUM_IMAGE_PER_SAMPLE
 
 # The dataset class for labeled data.
 class LabeledDataset(torch.utils.data.Dataset):    
-    def __init__(self, image_folder, annotation_file, scene_index, transform, extra_info=True):
+    def __init__(self, image_folder, annotation_file, scene_index, transform, extra_info=True, decode_threads=0):
         """
         Args:
             image_folder (string): the location of the image folder
@@ -90,49 +210,89 @@ class LabeledDataset(torch.utils.data.Dataset):
             scene_index (list): a list of scene indices for the unlabeled data 
             transform (Transform): The function to process the image
             extra_info (Boolean): whether you want the extra information
+            decode_threads (int): decode the cameras of a sample on this many threads, 0 decodes them in turn
         """
         
         self.image_folder = image_folder
-        self.annotation_dataframe = pd.read_csv(annotation_file)
+        self.annotation_file = annotation_file
         self.scene_index = scene_index
         self.transform = transform
         self.extra_info = extra_info
+        self.decode_threads = decode_threads
+
+        # the annotations are loaded on first use, in every DataLoader worker
+        self._annotation_dataframe = None
+        self.annotations = None
+
+    def __getstate__(self):
+        # pickled into DataLoader workers without the annotations, each worker loads its own
+        state = self.__dict__.copy()
+        state['_annotation_dataframe'] = None
+        state['annotations'] = None
+
+        return state
+
+    @property
+    def annotation_dataframe(self):
+        if self._annotation_dataframe is None:
+            self._annotation_dataframe = pd.read_csv(self.annotation_file)
+
+        return self._annotation_dataframe
+
+    def load_annotations(self):
+        # (corners, categories, actions, offsets), see build_annotation_index
+        if self.annotations is None:
+            self.annotations = build_annotation_index(self.annotation_dataframe, self.scene_index)
+
+        return self.annotations
     
     def __len__(self):
         return self.scene_index.size * NUM_SAMPLE_PER_SCENE
 
+    def get_target(self, index):
+        annotation_corners, annotation_categories, _, annotation_offsets = self.load_annotations()
+        start, end = annotation_offsets[index], annotation_offsets[index + 1]
+        corners = annotation_corners[start:end]
+        categories = annotation_categories[start:end]
+
+        target = {}
+        # copies, so that callers can't modify the index
+        target['bounding_box'] = torch.tensor(corners).view(-1, 2, 4)
+        target['category'] = torch.tensor(categories)
+
+        return target
+
+    def get_ego_image(self, index):
+        scene_id = self.scene_index[index // NUM_SAMPLE_PER_SCENE]
+        sample_id = index % NUM_SAMPLE_PER_SCENE
+        ego_path = os.path.join(self.image_folder, f'scene_{scene_id}', f'sample_{sample_id}', 'ego.png')
+
+        return load_image(ego_path, torchvision.transforms.functional.to_tensor)
+
+    def get_road_image(self, index):
+        return convert_map_to_road_map(self.get_ego_image(index))
+
     def __getitem__(self, index):
         scene_id = self.scene_index[index // NUM_SAMPLE_PER_SCENE]
         sample_id = index % NUM_SAMPLE_PER_SCENE
         sample_path = os.path.join(self.image_folder, f'scene_{scene_id}', f'sample_{sample_id}') 
 
-        images = []
-        for image_name in image_names:
-            image_path = os.path.join(sample_path, image_name)
-            image = Image.open(image_path)
-            images.append(self.transform(image))
-        image_tensor = torch.stack(images)
+        image_tensor = load_sample_images(sample_path, self.transform, self.decode_threads)
 
-        data_entries = self.annotation_dataframe[(self.annotation_dataframe['scene'] == scene_id) & (self.annotation_dataframe['sample'] == sample_id)]
-        corners = data_entries[['fl_x', 'fr_x', 'bl_x', 'br_x', 'fl_y', 'fr_y','bl_y', 'br_y']].to_numpy()
-        categories = data_entries.category_id.to_numpy()
+        target = self.get_target(index)
         
-        ego_path = os.path.join(sample_path, 'ego.png')
-        ego_image = Image.open(ego_path)
-        ego_image = torchvision.transforms.functional.to_tensor(ego_image)
+        ego_image = self.get_ego_image(index)
         road_image = convert_map_to_road_map(ego_image)
         
-        target = {}
-        target['bounding_box'] = torch.as_tensor(corners).view(-1, 2, 4)
-        target['category'] = torch.as_tensor(categories)
-
         if self.extra_info:
-            actions = data_entries.action_id.to_numpy()
+            _, _, annotation_actions, annotation_offsets = self.load_annotations()
+            start, end = annotation_offsets[index], annotation_offsets[index + 1]
+            actions = annotation_actions[start:end]
             # You can change the binary_lane to False to get a lane with 
             lane_image = convert_map_to_lane_map(ego_image, binary_lane=True)
             
             extra = {}
-            extra['action'] = torch.as_tensor(actions)
+            extra['action'] = torch.tensor(actions)
             extra['ego_image'] = ego_image
             extra['lane_image'] = lane_image
 
@@ -141,4 +301,162 @@ class LabeledDataset(torch.utils.data.Dataset):
         else:
             return image_tensor, target, road_image
 
-    
\ No newline at end of file
+    
+
+STORE_MANIFEST = 'manifest.json'
+STORE_VERSION = 1
+
+def read_store_manifest(store_folder):
+    with open(os.path.join(store_folder, STORE_MANIFEST)) as f:
+        manifest = json.load(f)
+
+    if manifest['version'] != STORE_VERSION:
+        raise ValueError(f'{store_folder} has sample store version {manifest["version"]}, '
+                         f'expected {STORE_VERSION}. Please rebuild it with build_sample_store.py')
+    if manifest['image_names'] != image_names:
+        raise ValueError(f'{store_folder} was built with cameras {manifest["image_names"]}')
+
+    return manifest
+
+def write_array(path, shape, dtype, rows):
+    # written to a temporary file first, so an interrupted build never
+    # leaves a truncated array behind
+    tmp_path = path + '.tmp'
+    array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+    for i, row in enumerate(rows):
+        array[i] = row
+    array.flush()
+    del array
+
+    os.replace(tmp_path, path)
+
+def images_to_float(images):
+    # same values as torchvision.transforms.ToTensor on the decoded images
+    return images.float().div(255)
+
+class SampleStore():
+    def __init__(self, store_folder, scene_index):
+        """
+        Read access to the scenes of a sample store written by build_sample_store.py
+
+        Args:
+            store_folder (string): the location of the sample store
+            scene_index (list): the scene indices that will be read
+        """
+
+        self.store_folder = store_folder
+        self.manifest = read_store_manifest(store_folder)
+
+        missing = [scene_id for scene_id in scene_index if str(scene_id) not in self.manifest['scenes']]
+        if missing:
+            raise KeyError(f'scenes {missing} are not in the sample store {store_folder}')
+
+        # memmaps are opened on first use
+        self.images = {}
+        self.road_maps = {}
+
+    def __getstate__(self):
+        # pickling a memmap copies its data, DataLoader workers open their own
+        state = self.__dict__.copy()
+        state['images'] = {}
+        state['road_maps'] = {}
+
+        return state
+
+    def _open(self, name):
+        # copy-on-write, so the arrays are writable and torch.from_numpy views don't warn
+        return np.load(os.path.join(self.store_folder, name), mmap_mode='c')
+
+    def get_images(self, scene_id, sample_id):
+        # uint8 [NUM_IMAGE_PER_SAMPLE, 3, H, W], a view on the memory-mapped file
+        if scene_id not in self.images:
+            self.images[scene_id] = self._open(self.manifest['scenes'][str(scene_id)]['images'])
+
+        return torch.from_numpy(self.images[scene_id][sample_id])
+
+    def get_road_map(self, scene_id, sample_id):
+        if scene_id not in self.road_maps:
+            road_maps = self.manifest['scenes'][str(scene_id)]['road_maps']
+            if road_maps is None:
+                raise KeyError(f'scene {scene_id} has no road maps in the sample store {self.store_folder}')
+            self.road_maps[scene_id] = self._open(road_maps)
+
+        width = self.manifest['road_map_shape'][1]
+        road_map = np.unpackbits(self.road_maps[scene_id][sample_id], axis=-1, count=width)
+
+        return torch.from_numpy(road_map.view(np.bool_))
+
+# The dataset class for unlabeled data, read from a sample store.
+class StoreUnlabeledDataset(UnlabeledDataset):
+    def __init__(self, store_folder, scene_index, first_dim, uint8=False):
+        """
+        Args:
+            store_folder (string): the location of the sample store
+            scene_index (list): a list of scene indices for the unlabeled data
+            first_dim ({'sample', 'image'}): see UnlabeledDataset
+            uint8 (Boolean): return the images as uint8 tensors instead of ToTensor floats
+        """
+
+        super(StoreUnlabeledDataset, self).__init__(image_folder=None,
+                                                    scene_index=scene_index,
+                                                    first_dim=first_dim,
+                                                    transform=None)
+        self.store = SampleStore(store_folder, scene_index)
+        self.uint8 = uint8
+
+    def __getitem__(self, index):
+        if self.first_dim == 'sample':
+            scene_id = self.scene_index[index // NUM_SAMPLE_PER_SCENE]
+            sample_id = index % NUM_SAMPLE_PER_SCENE
+
+            image_tensor = self.store.get_images(scene_id, sample_id)
+
+            return image_tensor if self.uint8 else images_to_float(image_tensor)
+
+        elif self.first_dim == 'image':
+            scene_id = self.scene_index[index // (NUM_SAMPLE_PER_SCENE * NUM_IMAGE_PER_SAMPLE)]
+            sample_id = (index % (NUM_SAMPLE_PER_SCENE * NUM_IMAGE_PER_SAMPLE)) // NUM_IMAGE_PER_SAMPLE
+
+            image = self.store.get_images(scene_id, sample_id)[index % NUM_IMAGE_PER_SAMPLE]
+
+            return (image if self.uint8 else images_to_float(image)), index % NUM_IMAGE_PER_SAMPLE
+
+# The dataset class for labeled data, read from a sample store.
+class StoreLabeledDataset(LabeledDataset):
+    def __init__(self, store_folder, annotation_file, scene_index, uint8=False):
+        """
+        Args:
+            store_folder (string): the location of the sample store
+            annotation_file (string): the location of the annotations
+            scene_index (list): a list of scene indices for the labeled data
+            uint8 (Boolean): return the images as uint8 tensors instead of ToTensor floats
+
+        The store has no ego images, so there is no extra information.
+        """
+
+        super(StoreLabeledDataset, self).__init__(image_folder=None,
+                                                  annotation_file=annotation_file,
+                                                  scene_index=scene_index,
+                                                  transform=None,
+                                                  extra_info=False)
+        self.store = SampleStore(store_folder, scene_index)
+        self.uint8 = uint8
+
+    def __getitem__(self, index):
+        scene_id = self.scene_index[index // NUM_SAMPLE_PER_SCENE]
+        sample_id = index % NUM_SAMPLE_PER_SCENE
+
+        image_tensor = self.store.get_images(scene_id, sample_id)
+        if not self.uint8:
+            image_tensor = images_to_float(image_tensor)
+
+        target = self.get_target(index)
+        road_image = self.store.get_road_map(scene_id, sample_id)
+
+        return image_tensor, target, road_image
+
+    def get_road_image(self, index):
+        scene_id = self.scene_index[index // NUM_SAMPLE_PER_SCENE]
+        sample_id = index % NUM_SAMPLE_PER_SCENE
+
+        return self.store.get_road_map(scene_id, sample_id)
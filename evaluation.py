@@ -0,0 +1,137 @@
+# Single-pass evaluation: one KobeModel forward per batch gives both the bounding
+# boxes and the road map, and both scores are accumulated in the same loop.
+
+import collections
+import multiprocessing
+import concurrent.futures
+
+import torch
+
+from helper import compute_ats_bounding_boxes, compute_ts_road_map
+from prefetch import Prefetcher
+
+
+def collate_fn_eval(batch):
+    # stacked samples and road images, the targets stay a tuple since their number of boxes differs
+    sample, target, road_image = tuple(zip(*batch))[:3]
+
+    return torch.stack(sample), target, torch.stack(road_image)
+
+
+def iter_predictions(model_loader, dataloader):
+    """
+    Yields (index, predicted boxes, target boxes, predicted road map, road image)
+    for every sample of the dataloader, in order, all on the cpu.
+    The dataloader has to use collate_fn_eval.
+    """
+    index = 0
+
+    with torch.no_grad():
+        # the next batch is loaded in the background while the model runs
+        for sample, target, road_image in Prefetcher(dataloader):
+            boxes, road_maps = model_loader.get_bounding_boxes_and_road_map(sample)
+            road_maps = road_maps.cpu()
+
+            for k in range(sample.size(0)):
+                yield index, boxes[k].cpu(), target[k]['bounding_box'], road_maps[k], road_image[k]
+                index += 1
+
+
+def _init_score_worker():
+    # the workers score in parallel, one thread each avoids oversubscribing the cpus
+    torch.set_num_threads(1)
+
+
+def make_score_pool(score_workers):
+    """
+    The process pool of iter_scores, None for score_workers <= 0. Create it before the
+    loader and prefetch threads start. The workers come from a forkserver (spawn where there
+    is none), so they never inherit the threads or the locks those threads hold.
+    """
+    if score_workers <= 0:
+        return None
+
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+    return concurrent.futures.ProcessPoolExecutor(score_workers,
+                                                  mp_context=multiprocessing.get_context(method),
+                                                  initializer=_init_score_worker)
+
+
+def score_boxes(predicted_bounding_boxes, target_bounding_boxes):
+    return compute_ats_bounding_boxes(predicted_bounding_boxes, target_bounding_boxes)
+
+
+def score_sample(predicted_bounding_boxes, target_bounding_boxes, predicted_road_map, road_image):
+    ats_bounding_boxes, iou_max = score_boxes(predicted_bounding_boxes, target_bounding_boxes)
+    ts_road_map = compute_ts_road_map(predicted_road_map, road_image)
+
+    return ats_bounding_boxes, iou_max, ts_road_map
+
+
+def iter_scores(predictions, pool=None, max_pending=16):
+    """
+    Yields the predictions of iter_predictions with their
+    (ats_bounding_boxes, iou_max, ts_road_map) appended, in sample order.
+    With a pool from make_score_pool the box scores are computed by its processes
+    while the model runs on the next batches. The road map scores stay on this thread,
+    sending two 800 x 800 maps to a worker costs as much as scoring them.
+    """
+    if pool is None:
+        for prediction in predictions:
+            yield prediction + score_sample(*prediction[1:])
+        return
+
+    # max_pending bounds the number of predictions waiting to be scored
+    pending = collections.deque()
+
+    for prediction in predictions:
+        _, predicted_bounding_boxes, target_bounding_boxes, predicted_road_map, road_image = prediction
+        ts_road_map = compute_ts_road_map(predicted_road_map, road_image)
+        pending.append((prediction, ts_road_map, pool.submit(score_boxes, predicted_bounding_boxes, target_bounding_boxes)))
+
+        while len(pending) > max_pending or (pending and pending[0][2].done()):
+            prediction, ts_road_map, future = pending.popleft()
+            yield prediction + future.result() + (ts_road_map,)
+
+    while pending:
+        prediction, ts_road_map, future = pending.popleft()
+        yield prediction + future.result() + (ts_road_map,)
+
+
+def evaluate(model_loader, dataloader, verbose=False, on_sample=None, score_workers=0):
+    """
+    Returns the average bounding box threat score and road map threat score.
+    on_sample(index, predicted boxes, target boxes, predicted road map, road image,
+              ats_bounding_boxes, iou_max, ts_road_map) is called for every sample.
+    score_workers is the number of processes computing the box scores, 0 to score
+    on the main thread.
+    """
+    total = 0
+    total_ats_bounding_boxes = 0
+    total_ts_road_map = 0
+
+    # before iter_predictions starts the loader and prefetch threads
+    pool = make_score_pool(score_workers)
+
+    try:
+        # the scores are summed in sample order, whichever way they are computed
+        for result in iter_scores(iter_predictions(model_loader, dataloader), pool, max_pending=4 * score_workers):
+            i, predicted_bounding_boxes, target_bounding_boxes, predicted_road_map, road_image, \
+                ats_bounding_boxes, iou_max, ts_road_map = result
+
+            total += 1
+            total_ats_bounding_boxes += ats_bounding_boxes
+            total_ts_road_map += ts_road_map
+
+            if verbose:
+                print(f'{i} - Bounding Box Score: {ats_bounding_boxes:.4}')
+                print(f'{i} - Road Map Score: {ts_road_map:.4}')
+
+            if on_sample is not None:
+                on_sample(*result)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return total_ats_bounding_boxes / total, total_ts_road_map / total
@@ -0,0 +1,204 @@
+# Offline cache of the frozen encoder's camera encodings, so that the heads can
+# be trained without running PreTaskEncoder on every sample of every epoch.
+# The road maps, bit-packed, and the encoded YOLO targets are cached next to
+# them, so that an epoch reads no image at all.
+
+import os
+import glob
+import hashlib
+
+import numpy as np
+
+import torch
+
+from src import ENCODER_HIDDEN, S, B, transform_target
+from data_helper import NUM_IMAGE_PER_SAMPLE, write_array
+from helper import collate_fn
+
+
+def encoder_fingerprint(encoder):
+    # hash of the encoder weights, a changed encoder gets a new cache
+    digest = hashlib.sha256()
+    for name, tensor in sorted(encoder.state_dict().items()):
+        tensor = tensor.detach().cpu().contiguous()
+        digest.update(f'{name}:{tensor.dtype}:{tuple(tensor.shape)}'.encode())
+        digest.update(tensor.numpy().tobytes())
+
+    return digest.hexdigest()[:16]
+
+
+def scenes_fingerprint(scene_index):
+    return hashlib.sha256(' '.join(str(scene_id) for scene_id in scene_index).encode()).hexdigest()[:8]
+
+
+def feature_cache_path(cache_dir, encoder, scene_index, fp16=False):
+    return os.path.join(cache_dir,
+                        f'features_{scenes_fingerprint(scene_index)}'
+                        f'_{encoder_fingerprint(encoder)}'
+                        f'_{"fp16" if fp16 else "fp32"}.npy')
+
+
+def annotations_fingerprint(annotation_file):
+    # hash of the annotation file contents, edited annotations get new targets
+    digest = hashlib.sha256()
+    with open(annotation_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()[:16]
+
+
+def label_cache_paths(cache_dir, scene_index, annotation_file):
+    # the labels don't depend on the encoder, they are kept when it changes.
+    # the road maps come from the ego images, only the targets depend on the annotations
+    return (os.path.join(cache_dir, f'road_maps_{scenes_fingerprint(scene_index)}.npy'),
+            os.path.join(cache_dir, f'targets_{scenes_fingerprint(scene_index)}'
+                                    f'_{annotations_fingerprint(annotation_file)}.npy'))
+
+
+def build_label_cache(dataset, road_map_path, target_path, num_classes=10):
+    # road maps bit-packed along their width, [len(dataset), H, W / 8], and YOLO targets, [len(dataset), S, S, 5 x B + C]
+    road_map_shape = tuple(dataset.get_road_image(0).shape)
+    write_array(road_map_path,
+                (len(dataset), road_map_shape[0], (road_map_shape[1] + 7) // 8),
+                np.uint8,
+                (np.packbits(dataset.get_road_image(index).numpy(), axis=-1) for index in range(len(dataset))))
+
+    write_array(target_path,
+                (len(dataset), S, S, 5 * B + num_classes),
+                np.float32,
+                (transform_target([dataset.get_target(index)])[0].numpy() for index in range(len(dataset))))
+
+    return road_map_shape
+
+
+def build_feature_cache(kobe_model, dataset, path, fp16=False, batch_size=8, device='cpu'):
+    # encodes every sample of the dataset, in order, into a [len(dataset), 6, ENCODER_HIDDEN] array
+    loader = torch.utils.data.DataLoader(range(len(dataset)), batch_size=batch_size)
+
+    tmp_path = path + '.tmp'
+    features = np.lib.format.open_memmap(tmp_path,
+                                         mode='w+',
+                                         dtype=np.float16 if fp16 else np.float32,
+                                         shape=(len(dataset), NUM_IMAGE_PER_SAMPLE, ENCODER_HIDDEN))
+
+    kobe_model.eval()
+    with torch.no_grad():
+        for indices in loader:
+            sample = torch.stack([dataset[index][0] for index in indices.tolist()]).to(device)
+            x_enc = kobe_model.encode_cameras(sample)
+            features[indices[0]:indices[-1] + 1] = x_enc.half().cpu().numpy() if fp16 else x_enc.cpu().numpy()
+
+    features.flush()
+    del features
+
+    os.replace(tmp_path, path)
+
+
+def load_feature_cache(kobe_model, dataset, cache_dir, fp16=False, batch_size=8, device='cpu', verbose=False):
+    """
+    Returns a FeatureCacheDataset for the dataset, building the cache first if there is
+    none for the current encoder weights. Caches of other encoder weights for the same
+    scenes are removed.
+    """
+    if any(param.requires_grad for param in kobe_model.encoder.parameters()):
+        raise ValueError('the feature cache needs a frozen encoder, '
+                         'load pretrained encoder weights first')
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = feature_cache_path(cache_dir, kobe_model.encoder, dataset.scene_index, fp16)
+
+    if not os.path.exists(path):
+        fingerprint = encoder_fingerprint(kobe_model.encoder)
+        for stale_path in glob.glob(os.path.join(cache_dir, f'features_{scenes_fingerprint(dataset.scene_index)}_*.npy')):
+            if f'_{fingerprint}_' not in os.path.basename(stale_path):
+                os.remove(stale_path)
+
+        if verbose:
+            print(f'Building feature cache {path}')
+        build_feature_cache(kobe_model, dataset, path, fp16=fp16, batch_size=batch_size, device=device)
+        kobe_model.train()
+
+    road_map_path, target_path = label_cache_paths(cache_dir, dataset.scene_index, dataset.annotation_file)
+    if not (os.path.exists(road_map_path) and os.path.exists(target_path)):
+        for stale_path in glob.glob(os.path.join(cache_dir, f'targets_{scenes_fingerprint(dataset.scene_index)}*.npy')):
+            if stale_path != target_path:
+                os.remove(stale_path)
+
+        if verbose:
+            print(f'Building label cache {road_map_path}, {target_path}')
+        build_label_cache(dataset, road_map_path, target_path, num_classes=kobe_model.num_classes)
+
+    return FeatureCacheDataset(path, road_map_path, target_path, dataset)
+
+
+def feature_cache_collate_fn(batch):
+    """ Collate FeatureCacheDataset items like yolo_collate_fn, the YOLO targets are already encoded.
+    Returns:
+        (features, target, road_image, yolo_target) where features, road_image and yolo_target are stacked
+        and target is the tuple of the original targets.
+    """
+    features, target, road_image, yolo_target = collate_fn(batch)
+
+    return torch.stack(features), target, torch.stack(road_image), torch.stack(yolo_target)
+
+
+# The dataset class for cached encoder features of a labeled dataset.
+class FeatureCacheDataset(torch.utils.data.Dataset):
+    def __init__(self, path, road_map_path, target_path, dataset, road_map_width=800):
+        """
+        Args:
+            path (string): the location of the cache written by build_feature_cache
+            road_map_path, target_path (string): the locations of the labels written by build_label_cache
+            dataset (LabeledDataset): the dataset the cache was built from, for the annotations
+            road_map_width (int): the width of the road maps before packing
+        """
+
+        self.path = path
+        self.road_map_path = road_map_path
+        self.target_path = target_path
+        self.dataset = dataset
+        self.road_map_width = road_map_width
+
+        for cache_path in [path, road_map_path, target_path]:
+            num_samples = np.load(cache_path, mmap_mode='r').shape[0]
+            if num_samples != len(dataset):
+                raise ValueError(f'{cache_path} has {num_samples} samples, the dataset has {len(dataset)}')
+
+        # opened on first use, in every DataLoader worker
+        self.features = None
+        self.road_maps = None
+        self.targets = None
+
+    def __getstate__(self):
+        # pickling a memmap copies its data
+        state = self.__dict__.copy()
+        state['features'] = None
+        state['road_maps'] = None
+        state['targets'] = None
+
+        return state
+
+    def _open(self):
+        # copy-on-write, so that torch.from_numpy doesn't warn
+        self.features = np.load(self.path, mmap_mode='c')
+        self.road_maps = np.load(self.road_map_path, mmap_mode='c')
+        self.targets = np.load(self.target_path, mmap_mode='c')
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        # (features, target, road map, YOLO target), collated by feature_cache_collate_fn
+        if self.features is None:
+            self._open()
+
+        # [6, ENCODER_HIDDEN], a view on the cache for fp32 features
+        features = torch.from_numpy(self.features[index]).float()
+        road_image = np.unpackbits(self.road_maps[index], axis=-1, count=self.road_map_width).view(np.bool_)
+
+        # the annotations are already in memory, only needed for the original boxes
+        return (features,
+                self.dataset.get_target(index),
+                torch.from_numpy(road_image),
+                torch.from_numpy(self.targets[index]))
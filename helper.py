@@ -5,7 +5,11 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torchvision
 
-from shapely.geometry import Polygon
+try:
+    from shapely.geometry import Polygon
+except ImportError:
+    # only needed by compute_iou, the reference implementation of compute_iou_pairs
+    Polygon = None
 
 def convert_map_to_lane_map(ego_map, binary_lane):
     mask = (ego_map[0,:,:] == ego_map[1,:,:]) * (ego_map[1,:,:] == ego_map[2,:,:]) + (ego_map[0,:,:] == 250 / 255)
@@ -51,12 +55,15 @@ def compute_ats_bounding_boxes(boxes1, boxes2):
     condition_matrix = condition1_matrix * condition2_matrix * condition3_matrix * condition4_matrix
 
     iou_matrix = torch.zeros(num_boxes1, num_boxes2)
-    for i in range(num_boxes1):
-        for j in range(num_boxes2):
-            if condition_matrix[i][j]:
-                iou_matrix[i][j] = compute_iou(boxes1[i], boxes2[j])
+    i, j = condition_matrix.nonzero(as_tuple=True)
+    if i.numel() > 0:
+        iou_matrix[i, j] = compute_iou_pairs(boxes1[i], boxes2[j]).float()
 
-    iou_max = iou_matrix.max(dim=0)[0]
+    if num_boxes1 == 0:
+        # nothing predicted, so no ground truth box is matched
+        iou_max = torch.zeros(num_boxes2)
+    else:
+        iou_max = iou_matrix.max(dim=0)[0]
 
     iou_thresholds = [0.5, 0.6, 0.7, 0.8, 0.9]
     total_threat_score = 0
@@ -77,8 +84,118 @@ def compute_ts_road_map(road_map1, road_map2):
     return tp * 1.0 / (road_map1.sum() + road_map2.sum() - tp)
 
 def compute_iou(box1, box2):
+    if Polygon is None:
+        raise ImportError('compute_iou needs shapely, use compute_iou_pairs instead')
+
     a = Polygon(torch.t(box1)).convex_hull
     b = Polygon(torch.t(box2)).convex_hull
     
     return a.intersection(b).area / a.union(b).area
 
+def _cross(a, b):
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+def _convex_hull(boxes, eps=1e-9):
+    # corners of [n, 2, 4] boxes as a counter-clockwise [n, 4, 2] polygon. A corner
+    # inside the triangle of the other three is replaced by its predecessor, which
+    # leaves a zero length edge instead of changing the number of vertices.
+    points = boxes.transpose(1, 2)
+    center = points.mean(dim=1, keepdim=True)
+    angles = torch.atan2(points[..., 1] - center[..., 1], points[..., 0] - center[..., 0])
+    points = points.gather(1, angles.argsort(dim=1).unsqueeze(-1).expand_as(points))
+
+    previous = points.roll(1, dims=1)
+    turn = _cross(points - previous, points.roll(-1, dims=1) - points)
+    scale = (points - previous).norm(dim=-1) * (points.roll(-1, dims=1) - points).norm(dim=-1)
+    reflex = turn < -eps * scale
+
+    return torch.where(reflex.unsqueeze(-1), previous, points)
+
+def _polygon_area(points, count):
+    # shoelace formula over the first count[k] points of each [n, V, 2] polygon
+    index = torch.arange(points.size(1), device=points.device).expand(points.size(0), -1)
+    following = torch.where(index + 1 < count.unsqueeze(1), index + 1, torch.zeros_like(index))
+    following = points.gather(1, following.unsqueeze(-1).expand_as(points))
+    terms = _cross(points, following) * (index < count.unsqueeze(1))
+
+    return 0.5 * terms.sum(dim=1).abs()
+
+def _inside(points, polygon, eps=1e-9):
+    # whether each of the [n, K, 2] points lies in the matching convex [n, V, 2] polygon
+    edges = polygon.roll(-1, dims=1) - polygon
+    offsets = points.unsqueeze(2) - polygon.unsqueeze(1) # [n, K, V, 2]
+    side = _cross(edges.unsqueeze(1), offsets)
+
+    return (side >= -eps * edges.norm(dim=-1).unsqueeze(1)).all(dim=2)
+
+def _intersection_area(poly1, poly2, eps=1e-9):
+    # The intersection of two convex polygons is the convex hull of the corners of
+    # each polygon lying in the other one plus the crossings of their edges.
+    n, v = poly1.shape[:2]
+
+    start1 = poly1.unsqueeze(2)                          # [n, V, 1, 2]
+    edge1 = (poly1.roll(-1, dims=1) - poly1).unsqueeze(2)
+    start2 = poly2.unsqueeze(1)                          # [n, 1, V, 2]
+    edge2 = (poly2.roll(-1, dims=1) - poly2).unsqueeze(1)
+
+    denom = _cross(edge1, edge2)                         # [n, V, V]
+    parallel = denom.abs() <= eps * edge1.norm(dim=-1) * edge2.norm(dim=-1)
+    denom = torch.where(parallel, torch.ones_like(denom), denom)
+    t = _cross(start2 - start1, edge2) / denom
+    u = _cross(start2 - start1, edge1) / denom
+    crossing = ~parallel & (t >= -eps) & (t <= 1 + eps) & (u >= -eps) & (u <= 1 + eps)
+    crossings = (start1 + t.unsqueeze(-1) * edge1).view(n, v * v, 2)
+
+    points = torch.cat([poly1, poly2, crossings], dim=1)
+    valid = torch.cat([_inside(poly1, poly2, eps), _inside(poly2, poly1, eps), crossing.view(n, v * v)], dim=1)
+
+    # order the candidate points around their center, invalid ones last
+    count = valid.sum(dim=1)
+    center = (points * valid.unsqueeze(-1)).sum(dim=1) / count.clamp(min=1).unsqueeze(-1)
+    angles = torch.atan2(points[..., 1] - center[:, 1:], points[..., 0] - center[:, :1])
+    angles = torch.where(valid, angles, torch.full_like(angles, 2 * np.pi))
+    points = points.gather(1, angles.argsort(dim=1).unsqueeze(-1).expand_as(points))
+
+    return torch.where(count >= 3, _polygon_area(points, count), torch.zeros_like(count, dtype=points.dtype))
+
+def _is_axis_aligned(boxes):
+    # every corner sits on a different corner of the bounding rectangle
+    x, y = boxes[:, 0], boxes[:, 1]
+    on_x = (x == x.min(dim=1, keepdim=True)[0]) | (x == x.max(dim=1, keepdim=True)[0])
+    on_y = (y == y.min(dim=1, keepdim=True)[0]) | (y == y.max(dim=1, keepdim=True)[0])
+    code = (x == x.max(dim=1, keepdim=True)[0]).long() + 2 * (y == y.max(dim=1, keepdim=True)[0]).long()
+    distinct = code.sort(dim=1)[0] == torch.arange(4, device=boxes.device)
+
+    return (on_x & on_y & distinct).all(dim=1)
+
+def compute_iou_pairs(boxes1, boxes2):
+    """ IoU of the convex hulls of boxes1[k] and boxes2[k], both sized [n, 2, 4].
+    Gives the same result as compute_iou for every pair without shapely.
+    """
+    boxes1 = boxes1.double()
+    boxes2 = boxes2.double()
+    iou = torch.zeros(boxes1.size(0), dtype=torch.double, device=boxes1.device)
+
+    # exact fast path for pairs of axis-aligned boxes, like the ones our decoder emits
+    aligned = _is_axis_aligned(boxes1) & _is_axis_aligned(boxes2)
+    if aligned.any():
+        min1, max1 = boxes1[aligned].min(dim=2)[0], boxes1[aligned].max(dim=2)[0]
+        min2, max2 = boxes2[aligned].min(dim=2)[0], boxes2[aligned].max(dim=2)[0]
+        wh = (torch.min(max1, max2) - torch.max(min1, min2)).clamp(min=0)
+        inter = wh[:, 0] * wh[:, 1]
+        area1 = (max1 - min1).prod(dim=1)
+        area2 = (max2 - min2).prod(dim=1)
+        iou[aligned] = inter / (area1 + area2 - inter)
+
+    rotated = ~aligned
+    if rotated.any():
+        poly1 = _convex_hull(boxes1[rotated])
+        poly2 = _convex_hull(boxes2[rotated])
+        count = torch.full((poly1.size(0),), poly1.size(1), device=poly1.device)
+        area1 = _polygon_area(poly1, count)
+        area2 = _polygon_area(poly2, count)
+        inter = _intersection_area(poly1, poly2)
+        iou[rotated] = inter / (area1 + area2 - inter)
+
+    return iou
+
@@ -0,0 +1,135 @@
+# The KobeModel inference path (encoder, heads and box post processing) as one
+# module that works under torch.jit.script and torch.compile, and can be frozen
+# into a single deployable file. KobeNetwork alone is what gets exported to ONNX.
+
+from typing import Tuple
+
+import torch
+import torch.nn as nn
+
+from src import pred_decode_batch, batched_class_nms, boxes_to_corners
+from data_helper import images_to_float
+
+
+class KobeNetwork(nn.Module):
+    has_shared_decoder: torch.jit.Final[bool]
+    fused: torch.jit.Final[bool]
+
+    def __init__(self, kobe_model):
+        """
+        The encoder and both heads, without the box post processing, e.g. for ONNX export.
+        Args:
+            kobe_model (KobeModel): the trained model, its modules are shared, not copied
+        """
+        super(KobeNetwork, self).__init__()
+
+        self.encoder = kobe_model.encoder
+        self.yolo_decoder = kobe_model.yolo_decoder
+        self.rm_decoder = kobe_model.rm_decoder
+
+        self.has_shared_decoder = kobe_model.shared_decoder_bool
+        self.shared_decoder = kobe_model.shared_decoder if self.has_shared_decoder else nn.Identity()
+
+        # see KobeModel.fuse_heads, the first yolo_split outputs of the fused layer go to the YOLO head
+        self.fused = kobe_model.fused_heads is not None
+        self.fused_heads = kobe_model.fused_heads.linear if self.fused else nn.Identity()
+        self.yolo_split = kobe_model.fused_heads.split_sizes[0] if self.fused else 0
+
+    def forward(self, x):
+        # type: (Tensor) -> Tuple[Tensor, Tensor]
+        """
+        x is [n_batch, 6, 3, 256, 306], float or uint8.
+        Returns the YOLO predictions [n_batch, S, S, 5 x B + C] and the road map probabilities [n_batch, 800, 800].
+        """
+        if x.dtype == torch.uint8:
+            x = images_to_float(x)
+
+        n_batch, t = x.size(0), x.size(1)
+        x_enc = self.encoder(x.reshape(n_batch * t, x.size(2), x.size(3), x.size(4)))
+        x_enc = x_enc.view(n_batch, t, -1)
+        encoding = x_enc.reshape(n_batch, -1)
+
+        if self.fused:
+            head_inputs = self.fused_heads(encoding)
+            encoding_yolo = head_inputs[:, :self.yolo_split]
+            encoding_rm = head_inputs[:, self.yolo_split:]
+        elif self.has_shared_decoder:
+            encoding_yolo = self.shared_decoder(x_enc).reshape(n_batch, -1)
+            encoding_rm = encoding
+        else:
+            encoding_yolo = encoding
+            encoding_rm = encoding
+
+        return self.yolo_decoder(encoding_yolo), self.rm_decoder(encoding_rm)
+
+
+def detect_boxes(outputs, conf_thresh, prob_thresh, nms_thresh, num_classes, num_bboxes):
+    # type: (Tensor, float, float, float, int, int) -> Tuple[Tensor, Tensor]
+    """ The boxes of the whole batch [n_boxes, 2, 4], grouped by sample, and the number of boxes
+    of each sample [n_batch] from the YOLO predictions, as in KobeModel.get_bounding_boxes. """
+    boxes_normalized, class_labels, confidences, class_scores, offsets = pred_decode_batch(outputs,
+                                                                                           conf_thresh,
+                                                                                           prob_thresh,
+                                                                                           num_bboxes)
+    keep, counts = batched_class_nms(boxes_normalized,
+                                     confidences,
+                                     class_labels,
+                                     offsets,
+                                     num_classes,
+                                     nms_thresh)
+
+    return boxes_to_corners(boxes_normalized[keep]), counts
+
+
+class KobeInference(nn.Module):
+    def __init__(self, kobe_model):
+        """
+        Args:
+            kobe_model (KobeModel): the trained model, its modules are shared, not copied
+        """
+        super(KobeInference, self).__init__()
+
+        self.network = KobeNetwork(kobe_model)
+
+        self.num_classes = kobe_model.num_classes
+        self.num_bboxes = kobe_model.yolo_decoder.num_bboxes
+        self.prob_thresh = float(kobe_model.prob_thresh)
+        self.conf_thresh = float(kobe_model.conf_thresh)
+        self.nms_thresh = float(kobe_model.nms_thresh)
+
+    def forward(self, x):
+        # type: (Tensor) -> Tuple[Tensor, Tensor, Tensor]
+        """
+        x is [n_batch, 6, 3, 256, 306], float or uint8.
+        Returns the boxes of the whole batch [n_boxes, 2, 4], grouped by sample,
+        the number of boxes of each sample [n_batch] and the road map probabilities [n_batch, 800, 800].
+        """
+        outputs, road_map = self.network(x)
+        boxes, counts = detect_boxes(outputs,
+                                     self.conf_thresh,
+                                     self.prob_thresh,
+                                     self.nms_thresh,
+                                     self.num_classes,
+                                     self.num_bboxes)
+
+        return boxes, counts, road_map
+
+
+def split_boxes(boxes, counts):
+    # the per sample tuple of [N, 2, 4] boxes, as KobeModel.get_bounding_boxes returns them
+    return torch.split(boxes, counts.tolist())
+
+
+def freeze(kobe_model):
+    # the scripted and frozen inference graph of a KobeModel, its thresholds included
+    kobe_model.eval()
+
+    return torch.jit.freeze(torch.jit.script(KobeInference(kobe_model).eval()))
+
+
+def save_frozen(kobe_model, path):
+    torch.jit.save(freeze(kobe_model), path)
+
+
+def load_frozen(path, device='cpu'):
+    return torch.jit.load(path, map_location=device)
@@ -0,0 +1,144 @@
+# Dynamic batching in front of ModelLoader: samples arrive one at a time, are
+# queued, and run as micro-batches through a single joint forward.
+
+import time
+import asyncio
+import concurrent.futures
+
+import torch
+
+
+class BatchingServer():
+    def __init__(self, model_loader, max_batch_size=8, max_wait=0.005):
+        """
+        Args:
+            model_loader (ModelLoader): runs the batches
+            max_batch_size (int): the most samples run in one forward
+            max_wait (float): how long, in seconds, the first sample of a batch waits for others
+        """
+
+        self.model_loader = model_loader
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.executor = None
+        self.queue = None
+        self.batcher = None
+
+        self.batches = 0
+        self.samples = 0
+
+    async def start(self):
+        if self.batcher is not None:
+            raise RuntimeError('the server is already started')
+
+        # one thread runs the model, so the event loop stays free to queue samples.
+        # a new one on every start, stop shuts it down
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.queue = asyncio.Queue()
+        self.batcher = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self.batcher is None:
+            return
+
+        self.batcher.cancel()
+        try:
+            await self.batcher
+        except asyncio.CancelledError:
+            pass
+
+        # whatever is still queued will not run
+        while not self.queue.empty():
+            _, future = self.queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError('the server was stopped'))
+
+        # a cancelled forward may still be running, wait for it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+
+        # the server can be started again
+        self.batcher = None
+        self.executor = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def predict(self, sample):
+        """
+        Queues one [6, 3, 256, 306] sample and returns its (boxes [N, 2, 4], binary road map [800, 800]),
+        both on the cpu.
+        """
+        # nothing would answer the request of a stopped server
+        if self.batcher is None or self.batcher.done():
+            raise RuntimeError('the server is not started')
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sample, future))
+
+        return await future
+
+    def _forward(self, samples):
+        with torch.no_grad():
+            boxes, road_maps = self.model_loader.get_bounding_boxes_and_road_map(torch.stack(samples))
+
+            return [box.cpu() for box in boxes], road_maps.cpu()
+
+    async def _next_batch(self, batch):
+        # waits for a first sample, then for more until the batch is full or max_wait is over.
+        # batch is filled in place, so the samples already taken are known if this is cancelled
+        batch.append(await self.queue.get())
+        deadline = time.perf_counter() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # take what arrived meanwhile without waiting
+        while len(batch) < self.max_batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = []
+            try:
+                await self._next_batch(batch)
+                # callers that gave up are not run
+                batch = [(sample, future) for sample, future in batch if not future.cancelled()]
+                if not batch:
+                    continue
+
+                samples, futures = zip(*batch)
+                try:
+                    boxes, road_maps = await loop.run_in_executor(self.executor, self._forward, samples)
+                except Exception as exception:
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(exception)
+                    continue
+            except asyncio.CancelledError:
+                # stopped while the batch was assembled or run, its callers are not left waiting
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(RuntimeError('the server was stopped'))
+                raise
+
+            self.batches += 1
+            self.samples += len(samples)
+            for k, future in enumerate(futures):
+                if not future.done():
+                    future.set_result((boxes[k], road_maps[k]))
+
+    def mean_batch_size(self):
+        return self.samples / max(self.batches, 1)
@@ -0,0 +1,79 @@
+#! /usr/bin/env python3
+
+import time
+import random
+import asyncio
+import argparse
+
+import numpy as np
+
+import torch
+
+from model_loader import ModelLoader
+from inference_server import BatchingServer
+
+
+async def timed_predict(server, sample, latencies):
+    start = time.perf_counter()
+    await server.predict(sample)
+    latencies.append(time.perf_counter() - start)
+
+
+async def run_load(model_loader, samples, rate, duration, max_batch_size, max_wait, seed=0):
+    # open loop: requests arrive as a poisson process of the given rate, whatever the latency
+    rng = random.Random(seed)
+    latencies = []
+
+    async with BatchingServer(model_loader, max_batch_size=max_batch_size, max_wait=max_wait) as server:
+        # one untimed request so that the first batch doesn't pay for the warmup
+        await server.predict(samples[0])
+        server.batches = server.samples = 0
+
+        requests = []
+        start = time.perf_counter()
+        next_arrival = start
+        while next_arrival - start < duration:
+            await asyncio.sleep(max(next_arrival - time.perf_counter(), 0))
+            requests.append(asyncio.ensure_future(timed_predict(server, samples[len(requests) % len(samples)], latencies)))
+            next_arrival += rng.expovariate(rate)
+
+        await asyncio.gather(*requests)
+        elapsed = time.perf_counter() - start
+
+        return {'requests': len(requests),
+                'throughput': len(requests) / elapsed,
+                'p50_ms': 1000 * float(np.percentile(latencies, 50)),
+                'p99_ms': 1000 * float(np.percentile(latencies, 99)),
+                'mean_batch_size': server.mean_batch_size(),
+                }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filename', type=str, default='combined_model.pt')
+    parser.add_argument('--batch_norm', action='store_true')
+    parser.add_argument('--shared_decoder', action='store_true')
+    parser.add_argument('--rates', type=float, nargs='+', default=[2, 5, 10],
+                        help='requests per second to offer')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds of requests per rate')
+    parser.add_argument('--max_batch_sizes', type=int, nargs='+', default=[1, 8],
+                        help='1 runs every request on its own, for comparison')
+    parser.add_argument('--max_wait', type=float, default=0.005)
+    parser.add_argument('--num_samples', type=int, default=8,
+                        help='distinct random samples the requests cycle through')
+    opt = parser.parse_args()
+
+    torch.manual_seed(0)
+
+    model_loader = ModelLoader(model_file=opt.filename,
+                               batch_norm=opt.batch_norm,
+                               shared_decoder=opt.shared_decoder)
+    samples = [torch.rand(6, 3, 256, 306) for _ in range(opt.num_samples)]
+
+    print(f'{"max batch":>9} {"offered/s":>9} {"served/s":>9} {"p50 ms":>9} {"p99 ms":>9} {"mean batch":>10}')
+    for max_batch_size in opt.max_batch_sizes:
+        for rate in opt.rates:
+            result = asyncio.run(run_load(model_loader, samples, rate, opt.duration, max_batch_size, opt.max_wait))
+            print(f'{max_batch_size:>9} {rate:>9.1f} {result["throughput"]:>9.1f} {result["p50_ms"]:>9.1f} '
+                  f'{result["p99_ms"]:>9.1f} {result["mean_batch_size"]:>10.2f}')
@@ -10,6 +10,10 @@ import torchvision
 
 # import your model class
 from src import KobeModel
+from data_helper import to_uint8_tensor
+from profiling import StageTimer, stage
+from inference_graph import save_frozen, load_frozen, split_boxes
+from onnx_backend import OnnxGraph
 
 # Put your transform function here, we will use it for our dataloader
 def get_transform():
@@ -21,11 +25,12 @@ def get_transform():
 
 # Put your transform function here, we will use it for our dataloader
 # For bounding boxes task
-def get_transform_task1():
-    return torchvision.transforms.ToTensor()
+# with uint8=True the images stay uint8 and the model converts them once per batch
+def get_transform_task1(uint8=False):
+    return to_uint8_tensor if uint8 else torchvision.transforms.ToTensor()
 # For road map task
-def get_transform_task2():
-    return torchvision.transforms.ToTensor()
+def get_transform_task2(uint8=False):
+    return to_uint8_tensor if uint8 else torchvision.transforms.ToTensor()
 
 class ModelLoader():
     # Fill the information for your team
@@ -35,7 +40,7 @@ class ModelLoader():
     team_member = ['Nabeel Sarwar', 'Esteban Navarro Garaiz', 'Guido Petri']
     contact_email = 'gp1655@nyu.edu'
 
-    def __init__(self, model_file='combined_model.pt', prob_thresh=0.1, conf_thresh=0.1, nms_thresh=0.4, batch_norm=False, shared_decoder=False):
+    def __init__(self, model_file='combined_model.pt', prob_thresh=0.1, conf_thresh=0.1, nms_thresh=0.4, batch_norm=False, shared_decoder=False, quantize=False, quantize_shared_decoder=False, fuse_heads=True, frozen_file=None, backend='torch', onnx_file='combined_model.onnx'):
 
         # You should
         #       1. create the model object
@@ -43,6 +48,30 @@ class ModelLoader():
         #       3. call cuda()
         # self.model = ...
 
+        self.device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+        self.timer = None
+
+        # a graph written by save_frozen replaces the model, the thresholds are the ones it was saved with
+        self.graph = None
+        if frozen_file is not None:
+            self.model = None
+            self.graph = load_frozen(frozen_file, self.device)
+            return
+
+        # backend='onnx' runs the graph written by onnx_backend.export_onnx with onnxruntime on the cpu,
+        # the boxes are decoded with the thresholds given here
+        if backend == 'onnx':
+            self.model = None
+            self.device = 'cpu'
+            self.graph = OnnxGraph(onnx_file,
+                                   prob_thresh=prob_thresh,
+                                   conf_thresh=conf_thresh,
+                                   nms_thresh=nms_thresh,
+                                   num_classes=10)
+            return
+        if backend != 'torch':
+            raise ValueError(f'unknown backend {backend}, use torch or onnx')
+
         self.model = KobeModel(num_classes=10,
                                encoder_features=6,
                                rm_dim=800,
@@ -56,17 +85,45 @@ class ModelLoader():
         self.model.load_state_dict(torch.load(model_file))
         self.model.eval()
 
-        self.device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+        # one GEMM for the first layer of both heads, they only share their input without a shared decoder
+        if fuse_heads and not shared_decoder:
+            self.model.fuse_heads()
+
+        # int8 decoder heads, see KobeModel.quantize_heads. Quantized layers only run on the cpu
+        if quantize:
+            self.model.quantize_heads(shared_decoder=quantize_shared_decoder)
+            self.device = 'cpu'
 
         self.model.to(self.device)
 
+    def save_frozen(self, path):
+        # scripted and frozen encoder, heads and box post processing, load it with ModelLoader(frozen_file=path)
+        save_frozen(self.model, path)
+
+    def enable_profiling(self, cuda_memory=False, synchronize=None):
+        # records every stage of every call, see profiling.StageTimer
+        # a frozen or onnx graph only has the calls timed, not its stages
+        self.timer = StageTimer(self.device, cuda_memory=cuda_memory, synchronize=synchronize)
+        if self.model is not None:
+            self.model.set_timer(self.timer)
+
+        return self.timer
+
+    def disable_profiling(self):
+        self.timer = None
+        if self.model is not None:
+            self.model.set_timer(None)
 
     def get_bounding_boxes(self, samples):
         # samples is a cuda tensor with size [batch_size, 6, 3, 256, 306]
         # You need to return a tuple with size 'batch_size' and each element is a cuda tensor [N, 2, 4]
         # where N is the number of object
-        samples.to(self.device)
-        boxes, _ = self.model.get_bounding_boxes(samples)
+        with stage(self.timer, 'get_bounding_boxes'):
+            samples = samples.to(self.device)
+            if self.graph is not None:
+                boxes, _ = self.run_graph(samples)
+            else:
+                boxes, _ = self.model.get_bounding_boxes(samples)
 
         return boxes
 
@@ -74,10 +131,36 @@ class ModelLoader():
         # samples is a cuda tensor with size [batch_size, 6, 3, 256, 306]
         # You need to return a cuda tensor with size [batch_size, 800, 800]
 
-        samples.to(self.device)
-        road_map, _ = self.model.get_road_map(samples)
+        with stage(self.timer, 'get_binary_road_map'):
+            samples = samples.to(self.device)
+            if self.graph is not None:
+                _, road_map = self.run_graph(samples)
+            else:
+                road_map, _ = self.model.get_road_map(samples)
 
-        # binarize for a better score
-        road_map = road_map > 0.5
+            # binarize for a better score
+            road_map = road_map > 0.5
 
         return road_map
+
+    def get_bounding_boxes_and_road_map(self, samples):
+        # samples is a cuda tensor with size [batch_size, 6, 3, 256, 306]
+        # Returns both outputs above from a single encoder pass
+
+        with stage(self.timer, 'get_bounding_boxes_and_road_map'):
+            samples = samples.to(self.device)
+            if self.graph is not None:
+                boxes, road_map = self.run_graph(samples)
+            else:
+                boxes, road_map = self.model.get_bounding_boxes_and_road_map(samples)
+
+            # binarize for a better score
+            road_map = road_map > 0.5
+
+        return boxes, road_map
+
+    def run_graph(self, samples):
+        # the per sample boxes and the road map probabilities from the frozen or onnx graph
+        boxes, counts, road_map = self.graph(samples)
+
+        return split_boxes(boxes, counts), road_map
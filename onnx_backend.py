@@ -0,0 +1,104 @@
+#! /usr/bin/env python3
+
+# ONNX export of KobeModel's encoder and heads, and an onnxruntime backend for
+# ModelLoader. Box decoding and NMS stay in torch, on the graph's outputs.
+
+import inspect
+import argparse
+
+import numpy as np
+
+import torch
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+from inference_graph import KobeNetwork, detect_boxes
+from data_helper import images_to_float
+
+
+def export_onnx(kobe_model, path, opset_version=17):
+    # the encoder and both heads with a dynamic batch axis, see KobeNetwork
+    if any(type(module).__module__.startswith('torch.ao.nn.quantized') for module in kobe_model.modules()):
+        raise ValueError('quantized models cannot be exported to ONNX, export the fp32 model')
+
+    kobe_model.eval()
+    network = KobeNetwork(kobe_model).eval()
+    example = torch.rand(1, 6, 3, 256, 306, device=next(kobe_model.parameters()).device)
+
+    # the TorchScript based exporter, newer torch defaults to the dynamo one
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+
+    with torch.no_grad():
+        torch.onnx.export(network,
+                          (example,),
+                          path,
+                          input_names=['samples'],
+                          output_names=['yolo', 'road_map'],
+                          dynamic_axes={'samples': {0: 'batch'}, 'yolo': {0: 'batch'}, 'road_map': {0: 'batch'}},
+                          opset_version=opset_version,
+                          **kwargs)
+
+
+class OnnxGraph():
+    def __init__(self, path, prob_thresh=0.1, conf_thresh=0.1, nms_thresh=0.4, num_classes=10, num_bboxes=2, threads=None):
+        """
+        Called like a frozen inference graph: samples -> (boxes, counts, road map), on the cpu.
+        Args:
+            path (string): the file written by export_onnx
+            threads (int): intra op threads of the session, onnxruntime picks when None
+        """
+        if onnxruntime is None:
+            raise ImportError('the onnx backend needs onnxruntime')
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads is not None:
+            options.intra_op_num_threads = threads
+
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+        self.prob_thresh = prob_thresh
+        self.conf_thresh = conf_thresh
+        self.nms_thresh = nms_thresh
+        self.num_classes = num_classes
+        self.num_bboxes = num_bboxes
+
+    def __call__(self, samples):
+        if samples.dtype == torch.uint8:
+            samples = images_to_float(samples)
+        samples = np.ascontiguousarray(samples.detach().cpu().numpy(), dtype=np.float32)
+
+        outputs, road_map = self.session.run(['yolo', 'road_map'], {'samples': samples})
+        boxes, counts = detect_boxes(torch.from_numpy(outputs),
+                                     self.conf_thresh,
+                                     self.prob_thresh,
+                                     self.nms_thresh,
+                                     self.num_classes,
+                                     self.num_bboxes)
+
+        return boxes, counts, torch.from_numpy(road_map)
+
+
+if __name__ == '__main__':
+    from model_loader import ModelLoader
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filename', type=str, default='combined_model.pt')
+    parser.add_argument('--output', type=str, default='combined_model.onnx')
+    parser.add_argument('--batch_norm', action='store_true')
+    parser.add_argument('--shared_decoder', action='store_true')
+    parser.add_argument('--no_fuse_heads', action='store_true')
+    parser.add_argument('--opset_version', type=int, default=17)
+    opt = parser.parse_args()
+
+    model_loader = ModelLoader(model_file=opt.filename,
+                               batch_norm=opt.batch_norm,
+                               shared_decoder=opt.shared_decoder,
+                               fuse_heads=not opt.no_fuse_heads)
+    model_loader.model.to('cpu')
+
+    export_onnx(model_loader.model, opt.output, opt.opset_version)
+    print(f'Exported {opt.filename} to {opt.output}')
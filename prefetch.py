@@ -0,0 +1,134 @@
+# Background-thread prefetching: prepares and copies batch k + 1 to the device
+# while the training or evaluation step runs on batch k.
+
+import time
+import queue
+import threading
+
+import torch
+
+
+def apply_to_tensors(data, fn):
+    # applies fn to every tensor of nested tuples, lists and dicts
+    if torch.is_tensor(data):
+        return fn(data)
+    if isinstance(data, (tuple, list)):
+        return type(data)(apply_to_tensors(item, fn) for item in data)
+    if isinstance(data, dict):
+        return {key: apply_to_tensors(value, fn) for key, value in data.items()}
+
+    return data
+
+
+class _Error():
+    def __init__(self, exception):
+        self.exception = exception
+
+
+_END = object()
+
+
+class Prefetcher():
+    def __init__(self, data_loader, prepare=None, device='cpu', depth=2):
+        """
+        Args:
+            data_loader (iterable): yields the raw batches, usually a DataLoader
+            prepare (function): turns a raw batch into the batch to use, e.g. stacking
+                and target encoding. Runs in the background thread
+            device (string): where the tensors of the prepared batch are copied to
+            depth (int): how many prepared batches can wait for the consumer
+        """
+
+        self.data_loader = data_loader
+        self.prepare = prepare
+        self.device = torch.device(device)
+        self.depth = depth
+        self.cuda = self.device.type == 'cuda'
+
+        self.reset_metrics()
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def reset_metrics(self):
+        self.batches = 0
+        self.wait_time = 0.0
+        self.prepare_time = 0.0
+
+    def metrics(self):
+        # wait_time is the time the consumer was blocked waiting for data
+        return {'batches': self.batches,
+                'wait_time': self.wait_time,
+                'prepare_time': self.prepare_time,
+                'mean_wait_time': self.wait_time / max(self.batches, 1),
+                }
+
+    def _to_device(self, batch, stream):
+        if not self.cuda:
+            return apply_to_tensors(batch, lambda tensor: tensor.to(self.device)), None
+
+        # the copies only run asynchronously on the side stream from pinned host memory,
+        # pin_memory=True on the DataLoader pins the batches in its own thread
+        with torch.cuda.stream(stream):
+            batch = apply_to_tensors(batch, lambda tensor: tensor.to(self.device, non_blocking=True))
+            event = torch.cuda.Event()
+            event.record(stream)
+
+        return batch, event
+
+    def _put(self, batches, item, stop):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _worker(self, batches, stop):
+        stream = torch.cuda.Stream(self.device) if self.cuda else None
+
+        try:
+            for data in self.data_loader:
+                start = time.perf_counter()
+                batch = self.prepare(data) if self.prepare is not None else data
+                batch = self._to_device(batch, stream)
+                self.prepare_time += time.perf_counter() - start
+
+                if not self._put(batches, batch, stop):
+                    return
+            self._put(batches, _END, stop)
+        except BaseException as exception:
+            self._put(batches, _Error(exception), stop)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._worker, args=(batches, stop), daemon=True)
+        worker.start()
+
+        try:
+            while True:
+                start = time.perf_counter()
+                item = batches.get()
+                self.wait_time += time.perf_counter() - start
+
+                if item is _END:
+                    return
+                if isinstance(item, _Error):
+                    raise item.exception
+
+                batch, event = item
+                if event is not None:
+                    # the copies ran on the side stream, make the compute stream wait for them
+                    # and keep the allocator from reusing their memory too early
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    apply_to_tensors(batch, lambda tensor: tensor.record_stream(current_stream))
+
+                self.batches += 1
+                yield batch
+        finally:
+            stop.set()
+            worker.join()
@@ -1,11 +1,13 @@
 #! /usr/bin/env python3
 
+import argparse
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision
-from data_helper import UnlabeledDataset, LabeledDataset
+from data_helper import UnlabeledDataset, LabeledDataset, StoreUnlabeledDataset, seed_worker
+from prefetch import Prefetcher
 
 
 class PreTaskEncoder(nn.Module):
@@ -60,6 +62,12 @@ class TestNet(torch.nn.Module):
 if __name__ == '__main__':
     # test the architecture
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--sample_store', type=str, default=None,
+                        help='read the images from this sample store, see build_sample_store.py')
+    opt = parser.parse_args()
+
     np.random.seed(0)
     torch.manual_seed(0)
 
@@ -72,16 +80,25 @@ if __name__ == '__main__':
     # stolen straight from the examples
     transform = torchvision.transforms.ToTensor()
 
-    unlabeled_trainset = UnlabeledDataset(image_folder=image_folder,
-                                          scene_index=unlabeled_scene_index,
-                                          first_dim='image',
-                                          transform=transform)
-    # for some reason, with num_workers > 0 this always seems to fail with an 
-    # "Empty" error from pytorch. found nothing online about it. :/
+    def image_dataset(scene_index):
+        # one camera image per item, decoded from the image folder or read from the sample store
+        if opt.sample_store is not None:
+            return StoreUnlabeledDataset(store_folder=opt.sample_store,
+                                         scene_index=scene_index,
+                                         first_dim='image')
+
+        return UnlabeledDataset(image_folder=image_folder,
+                                scene_index=scene_index,
+                                first_dim='image',
+                                transform=transform)
+
+    unlabeled_trainset = image_dataset(unlabeled_scene_index)
     trainloader = torch.utils.data.DataLoader(unlabeled_trainset,
                                               batch_size=64,
                                               shuffle=True,
-                                              num_workers=0)
+                                              num_workers=opt.num_workers,
+                                              worker_init_fn=seed_worker,
+                                              pin_memory=torch.cuda.is_available())
 
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
@@ -97,9 +114,8 @@ if __name__ == '__main__':
         train_size = len(train_loader.dataset)
         
         for n in range(epoch):
-            for batch_idx, (data, target) in enumerate(train_loader):
-                # send to device
-                data, target = data.to(device), target.to(device)
+            # the next batch is sent to the device while this one trains
+            for batch_idx, (data, target) in enumerate(Prefetcher(train_loader, device=device)):
 
                 optimizer.zero_grad()
                 output = model(data)
@@ -124,9 +140,7 @@ if __name__ == '__main__':
         torch.cuda.empty_cache()
         
         # no need for enumerate() because we don't use batch_idx
-        for data, target in test_loader:
-            # send to device
-            data, target = data.to(device), target.to(device)
+        for data, target in Prefetcher(test_loader, device=device):
             
             output = model(data)
 
@@ -170,16 +184,13 @@ if __name__ == '__main__':
     
     assert cnn.__repr__() == 'TestNet(\n  (encoder): PreTaskEncoder(\n    (conv1): Conv2d(3, 6, kernel_size=(5, 5), stride=(1, 1))\n    (conv2): Conv2d(6, 3, kernel_size=(5, 5), stride=(1, 1))\n  )\n  (fc1): Linear(in_features=13359, out_features=50, bias=True)\n  (fc2): Linear(in_features=50, out_features=6, bias=True)\n)'
 
-    transform = torchvision.transforms.ToTensor()
-
-    labeled_trainset = UnlabeledDataset(image_folder=image_folder,
-                                        scene_index=labeled_scene_index,
-                                        first_dim='image',
-                                        transform=transform)
+    labeled_trainset = image_dataset(labeled_scene_index)
     testloader = torch.utils.data.DataLoader(labeled_trainset,
                                              batch_size=64,
                                              shuffle=True,
-                                             num_workers=0)
+                                             num_workers=opt.num_workers,
+                                             worker_init_fn=seed_worker,
+                                             pin_memory=torch.cuda.is_available())
 
     mistakes = test(cnn, testloader)
 
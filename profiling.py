@@ -0,0 +1,170 @@
+# Opt-in per-stage instrumentation of KobeModel: wall time, and on cuda the peak
+# allocated memory, of every stage of every call. Exported as counters and
+# histograms or as a Chrome trace (chrome://tracing, ui.perfetto.dev).
+
+import os
+import json
+import time
+import bisect
+import threading
+import contextlib
+import collections
+
+import torch
+
+
+# upper bounds of the histogram buckets, in milliseconds
+HISTOGRAM_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# what the model uses when no timer is set, entering it costs next to nothing
+NULL_STAGE = contextlib.nullcontext()
+
+
+def stage(timer, name):
+    # the context manager timing a stage, or NULL_STAGE without a timer
+    if timer is None:
+        return NULL_STAGE
+
+    return timer.stage(name)
+
+
+class _StageStats():
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.peak_memory = 0
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+
+    def add(self, duration, peak_memory):
+        self.count += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        self.peak_memory = max(self.peak_memory, peak_memory)
+        self.buckets[bisect.bisect_left(HISTOGRAM_BUCKETS_MS, 1000 * duration)] += 1
+
+
+class _Stage():
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.peak_memory = 0
+
+    def __enter__(self):
+        timer = self.timer
+        if timer.synchronize:
+            torch.cuda.synchronize(timer.device)
+        if timer.cuda_memory:
+            # the enclosing stages keep the peak reached so far before it is reset
+            open_stages = timer.open_stages()
+            peak_memory = torch.cuda.max_memory_allocated(timer.device)
+            for open_stage in open_stages:
+                open_stage.peak_memory = max(open_stage.peak_memory, peak_memory)
+            open_stages.append(self)
+            torch.cuda.reset_peak_memory_stats(timer.device)
+
+        self.start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *exc_info):
+        timer = self.timer
+        if timer.synchronize:
+            torch.cuda.synchronize(timer.device)
+
+        end = time.perf_counter()
+        if timer.cuda_memory:
+            self.peak_memory = max(self.peak_memory, torch.cuda.max_memory_allocated(timer.device))
+            timer.open_stages().pop()
+        timer.record(self.name, self.start, end, self.peak_memory)
+
+        return False
+
+
+class StageTimer():
+    def __init__(self, device='cpu', cuda_memory=False, synchronize=None, max_events=100000):
+        """
+        Args:
+            device (string): the device the model runs on
+            cuda_memory (bool): record the peak allocated cuda memory of every stage
+            synchronize (bool): synchronize cuda around every stage so that the wall time
+                is the stage's, defaults to True on cuda
+            max_events (int): how many of the latest stage calls are kept for the Chrome trace,
+                the counters and histograms cover all of them
+        """
+
+        self.device = torch.device(device)
+        is_cuda = self.device.type == 'cuda'
+
+        self.cuda_memory = cuda_memory and is_cuda
+        self.synchronize = is_cuda if synchronize is None else synchronize and is_cuda
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+        self.events = collections.deque(maxlen=max_events)
+        self.stats = collections.OrderedDict()
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def open_stages(self):
+        # the stages entered and not yet exited on this thread, outermost first
+        if not hasattr(self.local, 'stages'):
+            self.local.stages = []
+
+        return self.local.stages
+
+    def record(self, name, start, end, peak_memory=0):
+        with self.lock:
+            if name not in self.stats:
+                self.stats[name] = _StageStats()
+            self.stats[name].add(end - start, peak_memory)
+            self.events.append((name, start, end, peak_memory, threading.get_ident()))
+
+    def reset(self):
+        with self.lock:
+            self.origin = time.perf_counter()
+            self.events.clear()
+            self.stats.clear()
+
+    def counters(self):
+        # {stage: {count, total_ms, mean_ms, max_ms, peak_memory_bytes}}
+        with self.lock:
+            return {name: {'count': stats.count,
+                           'total_ms': 1000 * stats.total_time,
+                           'mean_ms': 1000 * stats.total_time / stats.count,
+                           'max_ms': 1000 * stats.max_time,
+                           'peak_memory_bytes': stats.peak_memory,
+                           }
+                    for name, stats in self.stats.items()}
+
+    def histograms(self):
+        # {stage: {le_ms: calls}}, the last bucket 'inf' takes the calls slower than every bound
+        with self.lock:
+            return {name: dict(zip([str(bound) for bound in HISTOGRAM_BUCKETS_MS] + ['inf'], stats.buckets))
+                    for name, stats in self.stats.items()}
+
+    def summary(self):
+        lines = [f'{"stage":>32} {"calls":>7} {"mean ms":>10} {"max ms":>10} {"total ms":>11} {"peak MB":>9}']
+        for name, counter in self.counters().items():
+            lines.append(f'{name:>32} {counter["count"]:>7} {counter["mean_ms"]:>10.3f} {counter["max_ms"]:>10.3f} '
+                         f'{counter["total_ms"]:>11.1f} {counter["peak_memory_bytes"] / 2 ** 20:>9.1f}')
+
+        return '\n'.join(lines)
+
+    def export_chrome_trace(self, path):
+        # complete ('X') events in microseconds
+        with self.lock:
+            events = [{'name': name,
+                       'ph': 'X',
+                       'ts': 1e6 * (start - self.origin),
+                       'dur': 1e6 * (end - start),
+                       'pid': os.getpid(),
+                       'tid': thread,
+                       'args': {'peak_memory_bytes': peak_memory} if self.cuda_memory else {},
+                       }
+                      for name, start, end, peak_memory, thread in self.events]
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -9,89 +9,88 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torchvision
 
-from data_helper import LabeledDataset
-from helper import compute_ats_bounding_boxes, compute_ts_road_map
-
-from model_loader import get_transform_task1, get_transform_task2, ModelLoader
-
-torch.backends.cudnn.deterministic = True
-torch.backends.cudnn.benchmark = False
-
-random.seed(0)
-np.random.seed(0)
-torch.manual_seed(0)
-torch.cuda.manual_seed(0)
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--data_dir', type=str, default='data')
-parser.add_argument('--testset', action='store_true')
-parser.add_argument('--verbose', action='store_true')
-opt = parser.parse_args()
-
-image_folder = opt.data_dir
-annotation_csv = f'{opt.data_dir}/annotation.csv'
-
-if opt.testset:
-    labeled_scene_index = np.arange(134, 148)
-else:
-    labeled_scene_index = np.arange(120, 134)
-
-# For bounding boxes task
-labeled_trainset_task1 = LabeledDataset(
-    image_folder=image_folder,
-    annotation_file=annotation_csv,
-    scene_index=labeled_scene_index,
-    transform=get_transform_task1(),
-    extra_info=False
-    )
-dataloader_task1 = torch.utils.data.DataLoader(
-    labeled_trainset_task1,
-    batch_size=1,
-    shuffle=False,
-    num_workers=0
-    )
-# For road map task
-labeled_trainset_task2 = LabeledDataset(
-    image_folder=image_folder,
-    annotation_file=annotation_csv,
-    scene_index=labeled_scene_index,
-    transform=get_transform_task2(),
-    extra_info=False
-    )
-dataloader_task2 = torch.utils.data.DataLoader(
-    labeled_trainset_task2,
-    batch_size=1,
-    shuffle=False,
-    num_workers=0
-    )
-
-model_loader = ModelLoader()
-
-total = 0
-total_ats_bounding_boxes = 0
-total_ts_road_map = 0
-with torch.no_grad():
-    for i, data in enumerate(dataloader_task1):
-        total += 1
-        sample, target, road_image = data
-        sample = sample.cuda()
-
-        predicted_bounding_boxes = model_loader.get_bounding_boxes(sample)[0].cpu()
-        ats_bounding_boxes, iou_max = compute_ats_bounding_boxes(predicted_bounding_boxes, target['bounding_box'][0])
-        total_ats_bounding_boxes += ats_bounding_boxes
-
-        if opt.verbose:
-            print(f'{i} - Bounding Box Score: {ats_bounding_boxes:.4}')
-
-    for i, data in enumerate(dataloader_task2):
-        sample, target, road_image = data
-        sample = sample.cuda()
-
-        predicted_road_map = model_loader.get_binary_road_map(sample).cpu()
-        ts_road_map = compute_ts_road_map(predicted_road_map, road_image)
-        total_ts_road_map += ts_road_map
-
-        if opt.verbose:
-            print(f'{i} - Road Map Score: {ts_road_map:.4}')
-
-print(f'{model_loader.team_name} - {model_loader.round_number} - Bounding Box Score: {total_ats_bounding_boxes / total:.4} - Road Map Score: {total_ts_road_map / total:.4}')
+from data_helper import LabeledDataset, StoreLabeledDataset, default_decode_threads, seed_worker
+from evaluation import collate_fn_eval, evaluate
+
+from model_loader import get_transform_task1, ModelLoader
+
+# the score workers re-import this module, the script only runs in the main process
+if __name__ == '__main__':
+    torch.backends.cudnn.deterministic = True
+    torch.backends.cudnn.benchmark = False
+
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+    torch.cuda.manual_seed(0)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default='data')
+    parser.add_argument('--sample_store', type=str, default=None,
+                        help='read the images and road maps from this sample store, see build_sample_store.py')
+    parser.add_argument('--testset', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--score_workers', type=int, default=0,
+                        help='processes computing the box scores while the model runs, 0 to score on the main thread')
+    parser.add_argument('--uint8', action='store_true',
+                        help='load the images as uint8 and convert them on the model device')
+    parser.add_argument('--decode_threads', type=int, default=None,
+                        help='threads decoding the cameras of a sample, 0 to decode them in turn. '
+                             'By default the cores per loader process')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the time spent in every stage of the model')
+    parser.add_argument('--profile_trace', type=str, default=None,
+                        help='also write the stages as a Chrome trace to this file')
+    opt = parser.parse_args()
+
+    decode_threads = opt.decode_threads if opt.decode_threads is not None else default_decode_threads(opt.num_workers)
+
+    image_folder = opt.data_dir
+    annotation_csv = f'{opt.data_dir}/annotation.csv'
+
+    if opt.testset:
+        labeled_scene_index = np.arange(134, 148)
+    else:
+        labeled_scene_index = np.arange(120, 134)
+
+    # The task 1 and task 2 transforms are the same, so one pass gives both scores
+    if opt.sample_store is not None:
+        labeled_trainset = StoreLabeledDataset(
+            store_folder=opt.sample_store,
+            annotation_file=annotation_csv,
+            scene_index=labeled_scene_index,
+            uint8=opt.uint8
+            )
+    else:
+        labeled_trainset = LabeledDataset(
+            image_folder=image_folder,
+            annotation_file=annotation_csv,
+            scene_index=labeled_scene_index,
+            transform=get_transform_task1(uint8=opt.uint8),
+            extra_info=False,
+            decode_threads=decode_threads
+            )
+    dataloader = torch.utils.data.DataLoader(
+        labeled_trainset,
+        batch_size=opt.batch_size,
+        shuffle=False,
+        num_workers=opt.num_workers,
+        collate_fn=collate_fn_eval,
+        worker_init_fn=seed_worker
+        )
+
+    model_loader = ModelLoader()
+
+    if opt.profile or opt.profile_trace is not None:
+        model_loader.enable_profiling()
+
+    ats_bounding_boxes, ts_road_map = evaluate(model_loader, dataloader, verbose=opt.verbose, score_workers=opt.score_workers)
+
+    if model_loader.timer is not None:
+        print(model_loader.timer.summary())
+        if opt.profile_trace is not None:
+            model_loader.timer.export_chrome_trace(opt.profile_trace)
+
+    print(f'{model_loader.team_name} - {model_loader.round_number} - Bounding Box Score: {ats_bounding_boxes:.4} - Road Map Score: {ts_road_map:.4}')
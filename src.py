@@ -2,12 +2,12 @@
 
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 import torch.nn.functional as F
 import numpy as np
 import torchvision
-from data_helper import UnlabeledDataset, LabeledDataset
+from data_helper import UnlabeledDataset, LabeledDataset, images_to_float
 from helper import collate_fn, draw_box
+from profiling import stage
 
 BASE = 40
 WIDTH = 2 * 40
@@ -65,7 +65,116 @@ def target_encode(boxes, labels):
 
         return target
 
-   
+
+def target_encode_batch(boxes, labels, sample_index, n_batch):
+    """ Encode the box coordinates and class labels of a whole batch as one target tensor.
+    Args:
+        boxes: (tensor) [[x1, y1, x2, y2]_obj1, ...] for every sample in the batch, normalized from 0.0 to 1.0 w.r.t. image width/height.
+        labels: (tensor) [c_obj1, c_obj2, ...]
+        sample_index: (tensor) index of the sample each box belongs to, sized [n_boxes,].
+        n_batch: (int) number of samples in the batch.
+    Returns:
+        An encoded tensor sized [n_batch, S, S, 5 x B + C], 5=(x, y, w, h, conf), equal to stacking target_encode per sample.
+    """
+
+    C = NUM_CLASSES
+    N = 5 * B + C
+
+    target = torch.zeros(n_batch, S, S, N, device=boxes.device)
+    if boxes.size(0) == 0:
+        return target
+
+    cell_size = 1.0 / float(S)
+    boxes_wh = boxes[:, 2:] - boxes[:, :2] # width and height for each box, [n, 2]
+    boxes_xy = (boxes[:, 2:] + boxes[:, :2]) / 2.0 # center x & y for each box, [n, 2]
+
+    ij = (boxes_xy / cell_size).ceil() - 1.0 # x & y index of each box on the grid, [n, 2]
+    x0y0 = ij * cell_size # x & y of the cell left-top corner.
+    xy_normalized = (boxes_xy - x0y0) / cell_size # x & y of the box on the cell, normalized from 0.0 to 1.0.
+
+    # Boxes centered on the left/top border land on index -1, which target_encode wraps around.
+    ij = ij.long()
+    ij = torch.where(ij < 0, ij + S, ij)
+    if (ij >= S).any():
+        raise IndexError('box center lies outside of the grid')
+    sample_index = sample_index.to(boxes.device).long()
+    cells = (sample_index * S + ij[:, 1]) * S + ij[:, 0] # flat [n_batch, S(y), S(x)] cell index, [n,]
+
+    # When several boxes share a cell the last one wins, as in target_encode.
+    order = torch.arange(boxes.size(0), device=boxes.device)
+    last = torch.full((n_batch * S * S,), -1, dtype=torch.long, device=boxes.device)
+    last.scatter_reduce_(0, cells, order, reduce='amax')
+    winners = last[cells] == order
+
+    cell_target = torch.cat([xy_normalized, boxes_wh, torch.ones_like(boxes_wh[:, :1])], 1) # [n, 5]
+    target = target.view(n_batch * S * S, N)
+    target[cells[winners], :5*B] = cell_target[winners].repeat(1, B).to(target.dtype)
+    target[cells, 5*B + labels.to(boxes.device).long()] = 1.0
+
+    return target.view(n_batch, S, S, N)
+
+
+def yolo_collate_fn(batch):
+    """ Collate LabeledDataset items and encode the YOLO targets for the batch.
+    Meant to be used as the DataLoader collate_fn so that target encoding runs in the loader workers.
+    Returns:
+        (sample, target, road_image, yolo_target) where sample and road_image are stacked,
+        target is the tuple of the original targets and yolo_target is the encoded [n_batch, S, S, 5 x B + C] tensor.
+    """
+    sample, target, road_image = collate_fn(batch)[:3]
+
+    return torch.stack(sample), target, torch.stack(road_image), transform_target(target)
+
+
+def pred_decode_batch(pred_tensor, conf_thresh=0.1, prob_thresh=0.1, num_bboxes=B):
+    # type: (Tensor, float, float, int) -> Tuple[Tensor, Tensor, Tensor, Tensor, Tensor]
+    """ Decode a batch of tensors into box coordinates, class labels, and probs_detected.
+    Args:
+        pred_tensor: (tensor) tensor to decode sized [n_batch, S, S, 5 x B + C], 5=(x, y, w, h, conf)
+        num_bboxes: (int) B, the number of boxes per cell.
+    Returns:
+        boxes: (tensor) [[x1, y1, x2, y2]_obj1, ...] for the whole batch. Normalized from 0.0 to 1.0 w.r.t. image width/height, sized [n_boxes, 4].
+        labels: (tensor) class labels for each detected boxe, sized [n_boxes,].
+        confidences: (tensor) objectness confidences for each detected box, sized [n_boxes,].
+        class_scores: (tensor) scores for most likely class for each detected box, sized [n_boxes,].
+        offsets: (tensor) boxes of sample k are boxes[offsets[k]:offsets[k + 1]], sized [n_batch + 1,].
+    """
+    # from the arguments rather than the globals, so that the function can be scripted
+    n_batch, S, B = pred_tensor.size(0), pred_tensor.size(1), num_bboxes
+    cell_size = 1.0 / float(S)
+
+    # pred_decode walks the grid x-major, so put x before y to keep its box order.
+    pred = pred_tensor.transpose(1, 2)                          # [n_batch, S(x), S(y), N]
+    class_scores, class_labels = torch.max(pred[..., 5*B:], -1) # [n_batch, S, S]
+    bbox = pred[..., :5*B].reshape(n_batch, S, S, B, 5)         # [n_batch, S, S, B, 5]
+
+    conf = bbox[..., 4]                                         # [n_batch, S, S, B]
+    prob = conf * class_scores.unsqueeze(-1)                    # [n_batch, S, S, B]
+    # prob is compared in double precision, like float(prob) in pred_decode.
+    mask = ~(conf < conf_thresh) & ~(prob.double() < prob_thresh)
+
+    # Cell left-top corners, normalized from 0.0 to 1.0 w.r.t. image width/height.
+    grid = torch.arange(S, dtype=pred.dtype, device=pred.device)
+    x0y0_normalized = torch.stack([grid.view(S, 1).expand(S, S),
+                                   grid.view(1, S).expand(S, S)], -1) * cell_size # [S, S, 2]
+
+    xy_normalized = bbox[..., :2] * cell_size + x0y0_normalized.view(1, S, S, 1, 2) # box centers, [n_batch, S, S, B, 2]
+    wh_normalized = bbox[..., 2:4]                                                  # [n_batch, S, S, B, 2]
+    boxes_xyxy = torch.cat([xy_normalized - 0.5 * wh_normalized,   # left-top corner (x1, y1).
+                            xy_normalized + 0.5 * wh_normalized],  # right-bottom corner (x2, y2).
+                           -1)
+
+    boxes = boxes_xyxy[mask]                                                 # [n_boxes, 4]
+    labels = class_labels.unsqueeze(-1).expand_as(mask)[mask]                # [n_boxes, ]
+    confidences = conf[mask]                                                 # [n_boxes, ]
+    class_scores = class_scores.unsqueeze(-1).expand_as(mask)[mask]          # [n_boxes, ]
+
+    offsets = torch.zeros(n_batch + 1, dtype=torch.long, device=pred.device)
+    offsets[1:] = mask.reshape(n_batch, -1).sum(1).cumsum(0)
+
+    return boxes, labels, confidences, class_scores, offsets
+
+
 def pred_decode(pred_tensor, conf_thresh=0.1, prob_thresh=0.1):
         """ Decode tensor into box coordinates, class labels, and probs_detected.
         Args:
@@ -76,55 +185,9 @@ def pred_decode(pred_tensor, conf_thresh=0.1, prob_thresh=0.1):
             confidences: (tensor) objectness confidences for each detected box, sized [n_boxes,].
             class_scores: (tensor) scores for most likely class for each detected box, sized [n_boxes,].
         """
-        C = NUM_CLASSES
-        boxes, labels, confidences, class_scores = [], [], [], []
-
-        cell_size = 1.0 / float(S)
-
-        conf = pred_tensor[:, :, 4].unsqueeze(2) # [S, S, 1]
-        for b in range(1, B):
-            conf = torch.cat((conf, pred_tensor[:, :, 5*b + 4].unsqueeze(2)), 2)
-        conf_mask = conf > conf_thresh # [S, S, B]
-
-        # TBM, further optimization may be possible by replacing the following for-loops with tensor operations.
-        for i in range(S): # for x-dimension.
-            for j in range(S): # for y-dimension.
-                class_score, class_label = torch.max(pred_tensor[j, i, 5*B:], 0)
-
-                for b in range(B):
-                    conf = pred_tensor[j, i, 5*b + 4]
-                    prob = conf * class_score
-                    if conf < conf_thresh:
-                        continue
-                    if float(prob) < prob_thresh:
-                        continue
-
-                    # Compute box corner (x1, y1, x2, y2) from tensor.
-                    box = pred_tensor[j, i, 5*b : 5*b + 4]
-                    x0y0_normalized = FloatTensor([i, j]) * cell_size # cell left-top corner. Normalized from 0.0 to 1.0 w.r.t. image width/height.
-                    xy_normalized = box[:2] * cell_size + x0y0_normalized   # box center. Normalized from 0.0 to 1.0 w.r.t. image width/height.
-                    wh_normalized = box[2:] # Box width and height. Normalized from 0.0 to 1.0 w.r.t. image width/height.
-                    box_xyxy = FloatTensor(4) # [4,]
-                    box_xyxy[:2] = xy_normalized - 0.5 * wh_normalized # left-top corner (x1, y1).
-                    box_xyxy[2:] = xy_normalized + 0.5 * wh_normalized # right-bottom corner (x2, y2).
-
-                    # Append result to the lists.
-                    boxes.append(box_xyxy)
-                    labels.append(class_label)
-                    confidences.append(conf)
-                    class_scores.append(class_score)
-
-        if len(boxes) > 0:
-            boxes = torch.stack(boxes, 0) # [n_boxes, 4]
-            labels = torch.stack(labels, 0)             # [n_boxes, ]
-            confidences = torch.stack(confidences, 0)   # [n_boxes, ]
-            class_scores = torch.stack(class_scores, 0) # [n_boxes, ]
-        else:
-            # If no box found, return empty tensors.
-            boxes = FloatTensor(0, 4)
-            labels = LongTensor(0)
-            confidences = FloatTensor(0)
-            class_scores = FloatTensor(0)
+        boxes, labels, confidences, class_scores, _ = pred_decode_batch(pred_tensor.unsqueeze(0),
+                                                                        conf_thresh=conf_thresh,
+                                                                        prob_thresh=prob_thresh)
 
         return boxes, labels, confidences, class_scores
 
@@ -173,53 +236,98 @@ def nms(boxes, scores, nms_thresh = 0.35):
     return LongTensor(ids)
 
 
+def batched_class_nms(boxes, scores, labels, offsets, num_classes, nms_thresh=0.4):
+    # type: (Tensor, Tensor, Tensor, Tensor, int, float) -> Tuple[Tensor, Tensor]
+    """ Apply non maximum supression for every class of every sample in a single call.
+    Args:
+        boxes: (tensor) flat boxes of the whole batch as returned by pred_decode_batch, sized [n_boxes, 4].
+        scores: (tensor) scores used for supression, sized [n_boxes,].
+        labels: (tensor) class labels, sized [n_boxes,].
+        offsets: (tensor) boxes of sample k are boxes[offsets[k]:offsets[k + 1]], sized [n_batch + 1,].
+    Returns:
+        keep: (tensor) indices of the kept boxes grouped by sample, then by class, then by decreasing score.
+        counts: (tensor) number of kept boxes for each sample, sized [n_batch,].
+    """
+    n_batch = offsets.size(0) - 1
+    sample_index = torch.repeat_interleave(torch.arange(n_batch, device=boxes.device),
+                                           offsets[1:] - offsets[:-1])
+
+    # boxes of different (sample, class) groups never supress each other: every group is shifted apart
+    # and one nms runs on all of them, like torchvision.ops.batched_nms does for few boxes. The shift is
+    # in float64 so that it does not round the coordinates and flip supressions.
+    groups = sample_index * num_classes + labels
+    boxes = boxes.double()
+    shift = groups.double() * (boxes.max() + 1) if boxes.numel() > 0 else groups.double()
+    keep = torchvision.ops.nms(boxes + shift[:, None], scores.double(), nms_thresh)
+    # nms orders by decreasing score, the stable sort groups by sample and class and keeps that order
+    keep = keep[groups[keep].argsort(stable=True)]
+
+    counts = torch.bincount(sample_index[keep], minlength=n_batch)
+
+    return keep, counts
+
+
+def boxes_to_corners(boxes_normalized, map_width=WIDTH, map_height=HEIGHT):
+    # type: (Tensor, int, int) -> Tensor
+    """ Convert normalized [x1, y1, x2, y2] boxes to ego-frame corners.
+    Args:
+        boxes_normalized: (tensor) boxes normalized from 0.0 to 1.0, sized [n_boxes, 4].
+    Returns:
+        (tensor) corners in meters, clamped to the map, sized [n_boxes, 2, 4].
+    """
+    center_x = (boxes_normalized[:, 0] + boxes_normalized[:, 2]) / 2 * map_width
+    center_y = (boxes_normalized[:, 1] + boxes_normalized[:, 3]) / 2 * map_height
+    width = (boxes_normalized[:, 2] - boxes_normalized[:, 0]) * map_width
+    height = (boxes_normalized[:, 3] - boxes_normalized[:, 1]) * map_height
+
+    left = center_x - width / 2
+    right = center_x + width / 2
+    top = center_y - height / 2
+    bottom = center_y + height / 2
+
+    # reflect y and shift back from the upper left corner to the ego frame.
+    xs = torch.stack([left, left, right, right], 1) + (-40)
+    ys = torch.stack([top, bottom, top, bottom], 1).mul(-1) + 40
+
+    return torch.stack([xs, ys], 1).clamp(-40, 40)
+
+
 def transform_target(in_target):
-    
-    out_target = []
-    
-    for tgt_index in range(len(in_target)):
-        
-        #how many boxes for these target
-        nbox = in_target[tgt_index]['bounding_box'].shape[0]
-        individual_target = FloatTensor(nbox, 14).fill_(0)
-        
-        # CONVERT ALL THE BOUNDING BOXES for an individual sample at once
-        
-        bbox = in_target[tgt_index]['bounding_box'].to(device)
-        translation = FloatTensor(bbox.shape[0], bbox.shape[1], bbox.shape[2])
-        translation[:, 0, :].fill_(-40)
-        translation[:, 1, :].fill_(40)
-
-        # translate to uppert left
-        box = bbox - translation
-        # reflect y
-        box[:, 1, :].mul_(-1)
-
-        x_min = box[:, 0].min(dim = 1)[0]
-        y_min = box[:, 1].min(dim = 1)[0]
-        x_max = box[:, 0].max(dim = 1)[0]
-        y_max = box[:, 1].max(dim = 1)[0]
-
-
-        x_min = x_min / WIDTH
-        y_min = y_min / HEIGHT
-        x_max = x_max / WIDTH
-        y_max = y_max / HEIGHT
-        
+    """ Encode the ego-frame targets of a batch, sized [n_batch, S, S, 5 x B + C]. """
+
+    n_batch = len(in_target)
+    bbox = torch.cat([tgt['bounding_box'] for tgt in in_target], 0)
+    labels = torch.cat([tgt['category'] for tgt in in_target], 0)
+
+    # from which sample in the batch
+    nbox = torch.as_tensor([tgt['bounding_box'].shape[0] for tgt in in_target])
+    sample_index = torch.repeat_interleave(torch.arange(n_batch), nbox)
+
+    # CONVERT ALL THE BOUNDING BOXES in the batch at once
+    translation = torch.zeros(1, 2, 1, dtype=torch.float, device=bbox.device)
+    translation[:, 0, :].fill_(-40)
+    translation[:, 1, :].fill_(40)
+
+    # translate to uppert left
+    box = bbox - translation
+    # reflect y
+    box[:, 1, :].mul_(-1)
 
-        boxes = torch.stack([x_min, y_min, x_max, y_max], 1)
-
-        labels = IntTensor(nbox)
-        for box_index in range(nbox):
-            category = in_target[tgt_index]['category'][box_index]
-            
-            # from which sample in the batch
-            labels[box_index] = category
-            
-        individual_target = target_encode(boxes, labels)
-        out_target.append(individual_target)
+    x_min = box[:, 0].min(dim = 1)[0]
+    y_min = box[:, 1].min(dim = 1)[0]
+    x_max = box[:, 0].max(dim = 1)[0]
+    y_max = box[:, 1].max(dim = 1)[0]
+
+
+    x_min = x_min / WIDTH
+    y_min = y_min / HEIGHT
+    x_max = x_max / WIDTH
+    y_max = y_max / HEIGHT
         
-    return torch.stack(out_target, dim = 0) 
+
+    boxes = torch.stack([x_min, y_min, x_max, y_max], 1)
+
+    return target_encode_batch(boxes, labels, sample_index, n_batch)
 
 
 # works by side effects
@@ -276,6 +384,144 @@ def total_joint_loss(yolo_loss, rm_loss, lambd):
     return yolo_loss + lambd * rm_loss
 
 
+def peak_memory():
+    # peak resident memory of the process in bytes, ru_maxrss is in kilobytes on linux and bytes on macOS
+    import sys
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _probe_training_memory(model_path, n_batch, sample_shape, features):
+    # runs in the fresh process of measure_training_memory, whose peak memory so far is only the imports.
+    # prints how much loading the model and two Adam training steps on random batches add to it,
+    # the second step runs with the gradients and optimizer states of the first one allocated
+    baseline = peak_memory()
+
+    try:
+        kobe_model = torch.load(model_path, weights_only=False)
+        kobe_model.train()
+        optimizer = torch.optim.Adam(kobe_model.parameters())
+
+        for _ in range(2):
+            sample = torch.rand(n_batch, *sample_shape)
+            yolo_targets = torch.rand(n_batch, S, S, 5 * B + kobe_model.num_classes)
+            rm_targets = torch.rand(n_batch, 800, 800).round()
+
+            (output_yolo,
+             yolo_loss,
+             output_rm,
+             rm_loss) = kobe_model(None if features else sample,
+                                   yolo_targets=yolo_targets,
+                                   rm_targets=rm_targets,
+                                   x_enc=sample if features else None)
+            total_joint_loss(yolo_loss, rm_loss, 1).backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            del output_yolo, yolo_loss, output_rm, rm_loss
+    except MemoryError:
+        print('inf')
+        return
+
+    print(peak_memory() - baseline)
+
+
+def measure_training_memory(model_path, n_batch, sample_shape, features=False):
+    """ Memory Adam training of the model saved at model_path takes on the cpu, in bytes, with its
+    parameters, gradients, optimizer states and the batches. Every call runs in a fresh process, so
+    that the peak of an earlier, larger batch does not hide this one, and a batch that does not fit
+    only ends that process. inf if it ran out of memory.
+    Args:
+        model_path: (string) a KobeModel saved whole with torch.save.
+        sample_shape: (tuple) shape of one sample, [6, 3, 256, 306] or [6, ENCODER_HIDDEN] with features.
+    """
+    import os
+    import sys
+    import subprocess
+
+    # python -c does not import the calling script again
+    code = ('import sys, src; '
+            'src._probe_training_memory(sys.argv[1], int(sys.argv[2]), '
+            'tuple(int(size) for size in sys.argv[3].split(",")), sys.argv[4] == "1")')
+    result = subprocess.run([sys.executable, '-c', code, model_path, str(n_batch),
+                             ','.join(str(size) for size in sample_shape), '1' if features else '0'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True)
+
+    if result.returncode < 0:
+        # killed, e.g. by the out of memory killer
+        return float('inf')
+    if result.returncode != 0:
+        raise RuntimeError(f'the training memory probe of a batch of {n_batch} failed:\n{result.stderr}')
+
+    return float(result.stdout.split()[-1])
+
+
+def training_memory(kobe_model, n_batch, sample_shape, features=False, model_path=None):
+    """ Memory training kobe_model on batches of n_batch takes on the cpu, in bytes, see measure_training_memory.
+    Args:
+        model_path: (string) kobe_model already saved whole with torch.save, it is saved to a
+            temporary file otherwise.
+    """
+    import os
+    import tempfile
+
+    param_device = next(kobe_model.parameters()).device
+    if param_device.type != 'cpu':
+        raise ValueError('the training memory is measured on the cpu, move the model to the cpu first')
+
+    if model_path is not None:
+        return measure_training_memory(model_path, n_batch, sample_shape, features)
+
+    with tempfile.TemporaryDirectory() as folder:
+        model_path = os.path.join(folder, 'kobe_model.pt')
+        torch.save(kobe_model, model_path)
+
+        return measure_training_memory(model_path, n_batch, sample_shape, features)
+
+
+def smallest_micro_batch_size(kobe_model):
+    # batch norm needs at least 2 samples to train
+    batch_norm = any(isinstance(module, nn.modules.batchnorm._BatchNorm) for module in kobe_model.modules())
+
+    return 2 if batch_norm else 1
+
+
+def auto_micro_batch_size(kobe_model, memory_budget, sample_shape, features=False, max_batch_size=None):
+    """ The largest power of two micro-batch whose training memory on the cpu fits in memory_budget
+    bytes. Batch norm needs at least 2 samples. Raises a ValueError if not even the smallest batch fits.
+    Every size is measured in its own process, see measure_training_memory.
+    """
+    import os
+    import tempfile
+
+    n_batch = smallest_micro_batch_size(kobe_model)
+
+    with tempfile.TemporaryDirectory() as folder:
+        # saved once for all the sizes
+        model_path = os.path.join(folder, 'kobe_model.pt')
+        torch.save(kobe_model, model_path)
+
+        needed = training_memory(kobe_model, n_batch, sample_shape, features=features, model_path=model_path)
+        if needed > memory_budget:
+            raise ValueError(f'training on a micro-batch of {n_batch} takes {needed / 2 ** 30:.2f} GB, '
+                             f'over the budget of {memory_budget / 2 ** 30:.2f} GB')
+
+        micro_batch_size = n_batch
+        n_batch *= 2
+        while max_batch_size is None or n_batch <= max_batch_size:
+            if training_memory(kobe_model, n_batch, sample_shape, features=features, model_path=model_path) > memory_budget:
+                break
+            micro_batch_size = n_batch
+            n_batch *= 2
+
+    return micro_batch_size
+
+
 ENCODER_HIDDEN = int(26718 / 2)
 
 
@@ -301,8 +547,8 @@ class PreTaskEncoder(nn.Module):
         x = F.relu(x)
         x = F.max_pool2d(x, kernel_size=2)
 
-        # return an array shape
-        x = x.view(-1, ENCODER_HIDDEN)
+        # return an array shape, [n, ENCODER_HIDDEN]
+        x = x.view(x.size(0), -1)
         return x
 
 
@@ -392,6 +638,8 @@ class YoloDecoder(nn.Module):
         super(YoloDecoder, self).__init__()
 
         self.num_classes = num_classes
+        self.grid_size = S
+        self.num_bboxes = B
         
         # takes in dense output from encoder or shared decoder and puts into an
         # image of dim img_dim
@@ -436,7 +684,7 @@ class YoloDecoder(nn.Module):
         num_samples = x.shape[0]
 
         prediction = (
-            x.view(num_samples, S, S, 5 * B + self.num_classes)
+            x.view(num_samples, self.grid_size, self.grid_size, 5 * self.num_bboxes + self.num_classes)
             .contiguous()
         )
                 
@@ -536,7 +784,7 @@ class YoloLoss(nn.Module):
                                                                 # n_noobj: number of the cells which do not contain objects.
         noobj_target = target_tensor[noobj_mask].view(-1, N)    # target tensor on the cells which do not contain objects. [n_noobj, N]
                                                                 # n_noobj: number of the cells which do not contain objects.
-        noobj_conf_mask = BoolTensor(noobj_pred.size()).fill_(0) # [n_noobj, N]
+        noobj_conf_mask = torch.zeros_like(noobj_pred, dtype=torch.bool) # [n_noobj, N]
         for b in range(B):
             noobj_conf_mask[:, 4 + b*5] = 1 # noobj_conf_mask[:, 4] = 1; noobj_conf_mask[:, 9] = 1
         noobj_pred_conf = noobj_pred[noobj_conf_mask]       # [n_noobj, 2=len([conf1, conf2])]
@@ -544,38 +792,39 @@ class YoloLoss(nn.Module):
         loss_noobj = F.mse_loss(noobj_pred_conf, noobj_target_conf, reduction='sum')
 
         # Compute loss for the cells with objects.
-        coord_response_mask = BoolTensor(bbox_target.size()).fill_(0)    # [n_coord x B, 5]
-        coord_not_response_mask = BoolTensor(bbox_target.size()).fill_(1)# [n_coord x B, 5]
-        bbox_target_iou = torch.zeros(bbox_target.size())                    # [n_coord x B, 5], only the last 1=(conf,) is used
-
-        # Choose the predicted bbox having the highest IoU for each target bbox.
-        for i in range(0, bbox_target.size(0), B):
-            pred = bbox_pred[i:i+B] # predicted bboxes at i-th cell, [B, 5=len([x, y, w, h, conf])]
-            pred_xyxy = Variable(torch.FloatTensor(pred.size())) # [B, 5=len([x1, y1, x2, y2, conf])]
-            # Because (center_x,center_y)=pred[:, 2] and (w,h)=pred[:,2:4] are normalized for cell-size and image-size respectively,
-            # rescale (center_x,center_y) for the image-size to compute IoU correctly.
-            pred_xyxy[:,  :2] = pred[:, 2]/float(S) - 0.5 * pred[:, 2:4]
-            pred_xyxy[:, 2:4] = pred[:, 2]/float(S) + 0.5 * pred[:, 2:4]
+        n_coord = coord_pred.size(0)
+        with torch.no_grad():
+            pred = bbox_pred.view(n_coord, B, 5)        # predicted bboxes per cell, [n_coord, B, 5=len([x, y, w, h, conf])]
+            target = bbox_target.view(n_coord, B, 5)[:, :1] # target bbox per cell. Because target boxes contained by each cell are identical in current implementation, enough to extract the first one, [n_coord, 1, 5]
 
-            target = bbox_target[i] # target bbox at i-th cell. Because target boxes contained by each cell are identical in current implementation, enough to extract the first one.
-            target = bbox_target[i].view(-1, 5) # target bbox at i-th cell, [1, 5=len([x, y, w, h, conf])]
-            target_xyxy = Variable(torch.FloatTensor(target.size())) # [1, 5=len([x1, y1, x2, y2, conf])]
-            # Because (center_x,center_y)=target[:, 2] and (w,h)=target[:,2:4] are normalized for cell-size and image-size respectively,
+            # Because (center_x,center_y)=pred[:, 2] and (w,h)=pred[:,2:4] are normalized for cell-size and image-size respectively,
             # rescale (center_x,center_y) for the image-size to compute IoU correctly.
-            target_xyxy[:,  :2] = target[:, 2]/float(S) - 0.5 * target[:, 2:4]
-            target_xyxy[:, 2:4] = target[:, 2]/float(S) + 0.5 * target[:, 2:4]
-
-            iou = self.compute_iou(pred_xyxy[:, :4], target_xyxy[:, :4]) # [B, 1]
-            max_iou, max_index = iou.max(0)
-            max_index = max_index.data
-
-            coord_response_mask[i+max_index] = 1
-            coord_not_response_mask[i+max_index] = 0
+            # pred[:, 2] of a cell broadcasts over its B boxes, hence the unsqueeze(1).
+            pred_xyxy = torch.cat([pred[:, :, 2].unsqueeze(1)/float(S) - 0.5 * pred[:, :, 2:4],
+                                   pred[:, :, 2].unsqueeze(1)/float(S) + 0.5 * pred[:, :, 2:4]], -1)       # [n_coord, B, 4=len([x1, y1, x2, y2])]
+            target_xyxy = torch.cat([target[:, :, 2].unsqueeze(-1)/float(S) - 0.5 * target[:, :, 2:4],
+                                     target[:, :, 2].unsqueeze(-1)/float(S) + 0.5 * target[:, :, 2:4]], -1) # [n_coord, 1, 4=len([x1, y1, x2, y2])]
+
+            # IoU of every predicted bbox with the target bbox of its cell, same arithmetic as compute_iou.
+            lt = torch.max(pred_xyxy[:, :, :2], target_xyxy[:, :, :2]) # [n_coord, B, 2]
+            rb = torch.min(pred_xyxy[:, :, 2:], target_xyxy[:, :, 2:]) # [n_coord, B, 2]
+            wh = (rb - lt).clamp(min=0)
+            inter = wh[:, :, 0] * wh[:, :, 1] # [n_coord, B]
+            area1 = (pred_xyxy[:, :, 2] - pred_xyxy[:, :, 0]) * (pred_xyxy[:, :, 3] - pred_xyxy[:, :, 1]) # [n_coord, B]
+            area2 = (target_xyxy[:, :, 2] - target_xyxy[:, :, 0]) * (target_xyxy[:, :, 3] - target_xyxy[:, :, 1]) # [n_coord, 1]
+            iou = inter / (area1 + area2 - inter) # [n_coord, B]
+
+            # Choose the predicted bbox having the highest IoU for each target bbox.
+            max_iou, max_index = iou.max(1) # [n_coord, ]
+            response = F.one_hot(max_index, B).bool().view(-1, 1) # [n_coord x B, 1]
+
+            coord_response_mask = response.expand_as(bbox_target)     # [n_coord x B, 5]
+            coord_not_response_mask = ~coord_response_mask             # [n_coord x B, 5]
 
             # "we want the confidence score to equal the intersection over union (IOU) between the predicted box and the ground truth"
             # from the original paper of YOLO.
-            bbox_target_iou[i+max_index, LongTensor([4])] = (max_iou).data
-        bbox_target_iou = Variable(bbox_target_iou).to(device)
+            bbox_target_iou = torch.zeros_like(bbox_target)            # [n_coord x B, 5], only the last 1=(conf,) is used
+            bbox_target_iou[:, 4] = torch.where(response.view(n_coord, B), max_iou.unsqueeze(1), 0.0).view(-1)
 
         # BBox location/size and objectness loss for the response bboxes.
         bbox_pred_response = bbox_pred[coord_response_mask].view(-1, 5)      # [n_response, 5]
@@ -643,6 +892,32 @@ class RmDecoder(nn.Module):
         return x
 
 
+class FusedLinear(nn.Module):
+    # several Linear layers reading the same input, run as one GEMM and split again
+    def __init__(self, layers):
+        super(FusedLinear, self).__init__()
+        self.split_sizes = [layer.out_features for layer in layers]
+
+        self.linear = nn.Linear(layers[0].in_features, sum(self.split_sizes))
+        with torch.no_grad():
+            self.linear.weight.copy_(torch.cat([layer.weight for layer in layers], 0))
+            self.linear.bias.copy_(torch.cat([layer.bias for layer in layers], 0))
+
+    def forward(self, x):
+        return torch.split(self.linear(x), self.split_sizes, dim = 1)
+
+    def forward_one(self, x, k):
+        # the output of the k-th layer only
+        start = sum(self.split_sizes[:k])
+        end = start + self.split_sizes[k]
+
+        if isinstance(self.linear, nn.Linear):
+            return F.linear(x, self.linear.weight[start:end], self.linear.bias[start:end])
+
+        # e.g. quantized, the weights can't be sliced
+        return self.linear(x)[:, start:end]
+
+
 class KobeModel(nn.Module):
     
     def __init__(self, num_classes, encoder_features, rm_dim, prob_thresh=0.1, conf_thresh=0.1, nms_thresh=0.4, batch_norm=False, shared_decoder=False):
@@ -669,31 +944,108 @@ class KobeModel(nn.Module):
         self.conf_thresh = conf_thresh
         self.nms_thresh = nms_thresh
 
-    def encode_yolo(self, x):
-        
+        # profiling.StageTimer recording every stage, None when not profiling
+        self.timer = None
+
+        # the first Linear of both heads as one layer, see fuse_heads
+        self.fused_heads = None
+
+        # state_dicts of unfused models load into fused ones and the other way around
+        self._register_load_state_dict_pre_hook(self._map_fused_heads_state_dict)
+
+    def set_timer(self, timer):
+        self.timer = timer
+
+    def fuse_heads(self):
+        # inference only: both heads read the same encoding without a shared decoder,
+        # so their first Linear layers run as one GEMM over it
+        if self.shared_decoder_bool:
+            raise ValueError('the heads have different inputs with a shared decoder, they cannot be fused')
+        if self.fused_heads is not None:
+            return self
+
+        self.fused_heads = FusedLinear([self.yolo_decoder.m[0], self.rm_decoder.model[0]])
+        self.yolo_decoder.m[0] = nn.Identity()
+        self.rm_decoder.model[0] = nn.Identity()
+
+        return self
+
+    def _map_fused_heads_state_dict(self, state_dict, prefix, *args):
+        fused = prefix + 'fused_heads.linear.'
+        heads = [prefix + 'yolo_decoder.m.0.', prefix + 'rm_decoder.model.0.']
+
+        if self.fused_heads is not None and heads[0] + 'weight' in state_dict:
+            for name in ['weight', 'bias']:
+                state_dict[fused + name] = torch.cat([state_dict.pop(head + name) for head in heads], 0)
+        elif self.fused_heads is None and fused + 'weight' in state_dict:
+            split_sizes = [self.yolo_decoder.m[0].out_features, self.rm_decoder.model[0].out_features]
+            for name in ['weight', 'bias']:
+                for head, tensor in zip(heads, torch.split(state_dict.pop(fused + name), split_sizes, 0)):
+                    state_dict[head + name] = tensor
+
+    def head_input_layers(self, shared_decoder = True):
+        # the names of the 6 * ENCODER_HIDDEN wide Linear layers that hold nearly all of the weights
+        if self.fused_heads is not None:
+            return ['fused_heads.linear']
+
+        names = ['yolo_decoder.m.0', 'rm_decoder.model.0']
+        if shared_decoder and self.shared_decoder_bool:
+            names += ['shared_decoder.' + name for name, module in self.shared_decoder.named_modules()
+                      if isinstance(module, nn.Linear)]
+
+        return names
+
+    def quantize_heads(self, shared_decoder = False):
+        # int8 weights for the first Linear of both heads, and of the shared decoder if asked,
+        # activations are quantized on the fly so no calibration data is needed. cpu inference only
+        torch.quantization.quantize_dynamic(self,
+                                            set(self.head_input_layers(shared_decoder)),
+                                            dtype=torch.qint8,
+                                            inplace=True)
+
+        return self
+
+    def encode_cameras(self, x):
+        # per camera encoding, shared by both heads: [n_batch, 6, ENCODER_HIDDEN]
+        # the cameras are folded into the batch so the encoder runs as one big convolution
+        n_batch, t = x.shape[:2]
+        if x.dtype == torch.uint8:
+            # uint8 pipeline, same values as ToTensor in the dataset
+            x = images_to_float(x)
+        with stage(self.timer, 'encoder'):
+            x_enc = self.encoder(x.reshape(n_batch * t, *x.shape[2:]))
+
+        return x_enc.view(n_batch, t, ENCODER_HIDDEN)
+
+    def encode_yolo(self, x, x_enc = None):
+        if x_enc is None:
+            x_enc = self.encode_cameras(x)
+
         if self.shared_decoder_bool:
-            # should be [n_batch, 6, encoder_dim
-            n_batch = x.size(0)
-            t = x.size(1)
+            with stage(self.timer, 'shared_decoder'):
+                x_enc = self.shared_decoder(x_enc)
 
-            x_enc = FloatTensor(n_batch, t, ENCODER_HIDDEN).fill_(0)
-            for i in range(t):
-                x_enc[:, i, :] = self.encoder(x[:, i, :])
+        return x_enc.reshape(x_enc.size(0), -1)
 
-            x = self.shared_decoder(x_enc)
-            x = torch.cat([x[:, i, :] for i in range(t)], dim = 1)
-        else:
-            x = torch.cat([self.encoder(x[:, i, :]) for i in range(6)], dim = 1)
-            
-        return x 
+    def encode_rm(self, x, x_enc = None):
+        if x_enc is None:
+            x_enc = self.encode_cameras(x)
 
-    def encode_rm(self, x):
-        x = torch.cat([self.encoder(x[:, i, :]) for i in range(6)], dim = 1)
-        return x
+        return x_enc.reshape(x_enc.size(0), -1)
 
-    def forward(self, x, yolo_targets = None, rm_targets = None ):
-        encoding_yolo = self.encode_yolo(x)
-        encoding_rm = self.encode_rm(x)
+    def forward(self, x, yolo_targets = None, rm_targets = None, x_enc = None):
+        # the encoder only runs once, both heads start from the same camera encodings
+        # x_enc can be given instead of x, e.g. from a feature cache
+        if x_enc is None:
+            x_enc = self.encode_cameras(x)
+
+        if self.fused_heads is not None:
+            # the encodings are the outputs of the fused first layer
+            with stage(self.timer, 'fused_heads'):
+                encoding_yolo, encoding_rm = self.fused_heads(self.encode_rm(x, x_enc = x_enc))
+        else:
+            encoding_yolo = self.encode_yolo(x, x_enc = x_enc)
+            encoding_rm = self.encode_rm(x, x_enc = x_enc)
         
         output_1, yolo_loss = self.get_bounding_boxes(x, encoding = encoding_yolo, targets = yolo_targets)
         
@@ -703,17 +1055,26 @@ class KobeModel(nn.Module):
         # output1 is not in the context of our bounding boxes
         #return output_1, output_2, yolo_loss, rm_loss
         return output_1, yolo_loss, output_2, rm_loss
+
+    # for evaluation, both tasks from a single encoder pass
+    def get_bounding_boxes_and_road_map(self, x):
+        output_1, _, output_2, _ = self(x)
+
+        return output_1, output_2
     
     # for easy use for competition
     # in competition, encoding is None
+    # with fused heads, a given encoding is the output of the fused first layer
     def get_bounding_boxes(self, x, encoding = None, targets = None):
-        from torchvision.ops import nms as torch_nms
-
         if encoding is None:
             encoding = self.encode_yolo(x)
+            if self.fused_heads is not None:
+                with stage(self.timer, 'fused_heads'):
+                    encoding = self.fused_heads.forward_one(encoding, 0)
 
         
-        outputs = self.yolo_decoder(encoding)
+        with stage(self.timer, 'yolo_decoder'):
+            outputs = self.yolo_decoder(encoding)
         
         if targets is not None:
             yoloLossValue = self.yolo_loss(outputs, targets)
@@ -721,150 +1082,131 @@ class KobeModel(nn.Module):
             yoloLossValue = 0
         
         
-        boxes = []
-        
-        for output in outputs:
-            # Get detected boxes_detected, labels, confidences, class-scores.
-            boxes_normalized_all, class_labels_all, confidences_all, class_scores_all = pred_decode(output,
-                                               prob_thresh=self.prob_thresh,
-                                               conf_thresh=self.conf_thresh,
-                                               )
-            if boxes_normalized_all.size(0) == 0:
-                boxes.append(FloatTensor(outputs.shape[0], 2, 4))
-                continue
-
-            # Apply non maximum supression for boxes of each class.
-            boxes_normalized, class_labels, probs = [], [], []
-
-            for class_label in range(self.num_classes):
-                mask = (class_labels_all == class_label)
-                if torch.sum(mask) == 0:
-                    continue # if no box found, skip that class.
-
-                boxes_normalized_masked = boxes_normalized_all[mask]
-                class_labels_maked = class_labels_all[mask]
-                confidences_masked = confidences_all[mask]
-                class_scores_masked = class_scores_all[mask]
-
-                ids = torch_nms(boxes_normalized_masked, confidences_masked, self.nms_thresh)
-
-                boxes_normalized.append(boxes_normalized_masked[ids])
-                class_labels.append(class_labels_maked[ids])
-                probs.append(confidences_masked[ids] * class_scores_masked[ids])
-
-            boxes_normalized = torch.cat(boxes_normalized, 0)
-            class_labels = torch.cat(class_labels, 0)
-            probs = torch.cat(probs, 0)
-        
-
-            better_coordinates = FloatTensor(boxes_normalized.shape[0], 2, 4)
-            translation = FloatTensor(boxes_normalized.shape[0], 2, 4)
-            translation[:, 0, :].fill_(-40)
-            translation[:, 1, :].fill_(40)
-
-            center_x = (boxes_normalized[:, 0] + boxes_normalized[:, 2]) / 2 * WIDTH
-            center_y = (boxes_normalized[:, 1] + boxes_normalized[:, 3]) / 2 * HEIGHT
-            width = (boxes_normalized[:, 2] - boxes_normalized[:,0]) * WIDTH
-            height = (boxes_normalized[:, 3] - boxes_normalized[:,1]) * HEIGHT
-            
-            x1 = center_x - width/2
-            x2 = center_x + width/2
-            x3 = center_x - width/2
-            x4 = center_x + width/2
-            
-            
-            y1 = center_y - height/2
-            y2 = center_y + height/2
-            y3 = center_y + height/2
-            y4 = center_y - height/2
-            
-            better_coordinates[:, 0, 0] = x1
-            better_coordinates[:, 0, 1] = x2
-            better_coordinates[:, 0, 2] = x3
-            better_coordinates[:, 0, 3] = x4
-            
-            better_coordinates[:, 1, 0] = y1
-            better_coordinates[:, 1, 1] = y2
-            better_coordinates[:, 1, 2] = y3
-            better_coordinates[:, 1, 3] = y4
-            
-            better_coordinates[:, 1, :].mul_(-1)
-            # shift back!
-            better_coordinates += translation
-            
-            under_fourty = better_coordinates < -40
-            over_fourty = better_coordinates > 40
-
-            better_coordinates[under_fourty] = -40
-            better_coordinates[over_fourty] = 40
-
-            under_40 = better_coordinates < -40
-            over_40 = better_coordinates > 40
-
-            better_coordinates[under_40] = -40
-            better_coordinates[over_40] = 40
-
-            # reorder corners so it's clockwise from top left
-            better_coordinates = better_coordinates[:, :, [0, 2, 3, 1]]
-            
-            boxes.append(better_coordinates)
-        
-        #print('got this incoming')
-        #print(x.shape)
-        #print('got these many boxes to look at {}'.format(len(boxes)))
-        ##print('it has this many detections {} at one site'.format(boxes[0].shape[0]))
-        #print("looks like this")
-        #print(boxes[0])
-        return tuple(boxes), yoloLossValue
+        # Get detected boxes_detected, labels, confidences, class-scores for the whole batch.
+        with stage(self.timer, 'pred_decode'):
+            (boxes_normalized,
+             class_labels,
+             confidences,
+             class_scores,
+             offsets) = pred_decode_batch(outputs,
+                                          prob_thresh=self.prob_thresh,
+                                          conf_thresh=self.conf_thresh,
+                                          )
+
+        # Apply non maximum supression for boxes of each class of each sample.
+        with stage(self.timer, 'nms'):
+            keep, counts = batched_class_nms(boxes_normalized,
+                                             confidences,
+                                             class_labels,
+                                             offsets,
+                                             self.num_classes,
+                                             self.nms_thresh,
+                                             )
+
+        with stage(self.timer, 'corners'):
+            boxes = boxes_to_corners(boxes_normalized[keep])
+
+        return torch.split(boxes, counts.tolist()), yoloLossValue
     
     def get_road_map(self, x, encoding = None, targets = None):
         if encoding is None:
             encoding = self.encode_rm(x)
+            if self.fused_heads is not None:
+                with stage(self.timer, 'fused_heads'):
+                    encoding = self.fused_heads.forward_one(encoding, 1)
         
-        outputs = self.rm_decoder(encoding)
+        with stage(self.timer, 'rm_decoder'):
+            outputs = self.rm_decoder(encoding)
         bce_loss = nn.BCELoss()
         if targets is not None:
-            loss = bce_loss(outputs, targets) / x.shape[0]
+            loss = bce_loss(outputs, targets) / outputs.shape[0]
         else:
             loss = 0
         return outputs, loss
 
 
-def train_yolo(data_loader, kobe_model, kobe_optimizer, verbose, prince, lambd=20):
+def prepare_yolo_batch(data):
+    # (sample, yolo target, road image) from a loader batch, runs in the Prefetcher thread
+    if len(data) == 4:
+        # targets were already encoded by yolo_collate_fn in the loader
+        sample, _, road_image, target = data
+    else:
+        sample, target, road_image = data
+        sample = torch.stack(sample)
+        target = transform_target(target)
+        road_image = torch.stack(road_image)
+
+    return sample, target, road_image
+
+
+def accumulation_loss_scales(n_micro, n_batch):
+    """ Scales of the losses of a micro-batch of n_micro samples in an effective batch of n_batch,
+    such that the accumulated gradients are those of the whole batch at once.
+    YoloLoss is a mean over the batch, so it scales by n_micro / n_batch. The road map
+    loss is a mean over the pixels divided again by the batch size, so it scales by the square.
+    """
+    scale = n_micro / n_batch
+
+    return scale, scale ** 2
+
+
+def train_yolo(data_loader, kobe_model, kobe_optimizer, verbose, prince, lambd=20, features=False, step_callback=None,
+               accumulation_steps=1):
+    # with features=True the loader yields cached camera encodings instead of images
+    # step_callback(i) is called after optimizer step i, e.g. to checkpoint
+    # with accumulation_steps=K the gradients of K loader batches are summed before every optimizer step
+    from prefetch import Prefetcher
+
     kobe_model.train()
     train_loss = 0
 
     train_size = len(data_loader.dataset)
 
-    for i, data in enumerate(data_loader):
-        sample, target, road_image = data
-        sample = torch.stack(sample).to(device)
-        target_original = target
-        target = transform_target(target_original).to(device)
-        road_image = torch.stack(road_image).float().to(device)
+    # samples of this epoch, the last optimizer step can have fewer
+    epoch_size = len(data_loader.sampler)
+    step_size = data_loader.batch_size * accumulation_steps
+
+    # batch i + 1 is stacked, encoded and copied to the device while step i runs
+    batches = Prefetcher(data_loader, prepare_yolo_batch, device)
 
-        kobe_optimizer.zero_grad()
+    for i, (sample, target, road_image) in enumerate(batches):
+        road_image = road_image.float()
+
+        step, micro_step = divmod(i, accumulation_steps)
+        if micro_step == 0:
+            kobe_optimizer.zero_grad()
 
         (output_yolo,
          yolo_loss,
          output_rm,
-         rm_loss) = kobe_model(sample,
+         rm_loss) = kobe_model(None if features else sample,
                                yolo_targets=target,
-                               rm_targets=road_image)
+                               rm_targets=road_image,
+                               x_enc=sample if features else None)
+
+        n_batch = min(step_size, epoch_size - step * step_size)
+        yolo_scale, rm_scale = accumulation_loss_scales(sample.size(0), n_batch)
         
-        total_loss = total_joint_loss(yolo_loss, rm_loss, lambd)
+        total_loss = total_joint_loss(yolo_scale * yolo_loss, rm_scale * rm_loss, lambd)
         train_loss += (total_loss.item())
 
         total_loss.backward()
 
-        kobe_optimizer.step()
+        if micro_step == accumulation_steps - 1 or i == len(data_loader) - 1:
+            kobe_optimizer.step()
+
+            if step_callback is not None:
+                step_callback(step)
         
         if not prince:
             torch.cuda.empty_cache()
 
         if verbose and (i % 100 == 0):
-            print(f'[{i * len(data):05d}/{train_size}'
+            print(f'[{i * sample.size(0):05d}/{train_size}'
                   f' ({100 * i / len(data_loader):03.0f}%)]'
                   f'\tLoss: {train_loss:.6f}')
         
     print("TRAIN LOSS: {}".format(train_loss))
+
+    if verbose:
+        print(f'DATA WAIT: {batches.wait_time:.2f}s over {batches.batches} batches')
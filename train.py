@@ -1,13 +1,16 @@
 #! /usr/bin/env python3
 
 import os
+import math
 from src import load_model_from_encoder as model_from_encoder
 from src import initialize_model_from_file as model_from_file
 from src import train_yolo
+from src import auto_micro_batch_size, smallest_micro_batch_size
+from src import yolo_collate_fn
+from checkpoint import CheckpointWriter, TrainingCheckpointer, load_training_state
 import torch
 import torchvision
-from helper import collate_fn
-from data_helper import LabeledDataset
+from data_helper import LabeledDataset, StoreLabeledDataset, default_decode_threads, ResumableSampler, seed_worker, to_uint8_tensor
 import numpy as np
 import argparse
 
@@ -25,6 +28,33 @@ parser.add_argument('--continue_from', type=str)
 parser.add_argument('--batch_norm', action='store_true')
 parser.add_argument('--shared_decoder', action='store_true')
 parser.add_argument('--data_dir', type=str, default='data')
+parser.add_argument('--sample_store', type=str, default=None,
+                    help='read the images and road maps from this sample store, see build_sample_store.py')
+parser.add_argument('--feature_cache', type=str, default=None,
+                    help='train the heads on encoder features cached in this directory')
+parser.add_argument('--feature_cache_fp16', action='store_true')
+parser.add_argument('--num_workers', type=int, default=4)
+parser.add_argument('--uint8', action='store_true',
+                    help='load the images as uint8 and convert them on the model device')
+parser.add_argument('--decode_threads', type=int, default=None,
+                    help='threads decoding the cameras of a sample, 0 to decode them in turn. '
+                         'By default the cores per loader process')
+
+
+parser.add_argument('--save_every_steps', type=int, default=0,
+                    help='also checkpoint every this many optimizer steps, 0 to only checkpoint per epoch')
+parser.add_argument('--keep_last', type=int, default=3,
+                    help='how many epoch checkpoints, and step checkpoints, are kept')
+parser.add_argument('--resume', type=str, default=None,
+                    help='training state to restart from, with its optimizer, RNGs and position in the epoch')
+parser.add_argument('--seed', type=int, default=0,
+                    help='seed of the shuffling, epoch e uses seed + e')
+parser.add_argument('--accumulation_steps', type=int, default=1,
+                    help='micro-batches whose gradients are summed per optimizer step, '
+                         'the effective batch is batch_size x accumulation_steps')
+parser.add_argument('--memory_budget_gb', type=float, default=None,
+                    help='pick the largest micro-batch whose training fits this memory on the cpu, '
+                         'keeping the effective batch of batch_size x accumulation_steps')
 
 
 # need to fix this for preloaded encoder too, and continuing training
@@ -33,6 +63,11 @@ opt = parser.parse_args()
 
 print(opt)
 
+decode_threads = opt.decode_threads if opt.decode_threads is not None else default_decode_threads(opt.num_workers)
+
+if opt.resume is not None and not os.path.exists(opt.resume):
+    raise FileNotFoundError(f'Cannot resume training from {opt.resume}')
+
 if opt.continue_training:
     if not os.path.exists(opt.continue_from):
         print(f'Cannot continue training from {opt.continue_from}. '
@@ -79,38 +114,125 @@ n_epochs = opt.n_epochs
 image_folder = opt.data_dir
 annotation_csv = f'{image_folder}/annotation.csv'
 
-transform = torchvision.transforms.ToTensor()
+transform = to_uint8_tensor if opt.uint8 else torchvision.transforms.ToTensor()
 
 labeled_scene_index = np.arange(106, 134)
 
-labeled_trainset = LabeledDataset(image_folder=image_folder,
-                                  annotation_file=annotation_csv,
-                                  scene_index=labeled_scene_index,
-                                  transform=transform,
-                                  extra_info=False,
-                                  )
+if opt.sample_store is not None:
+    # pre-decoded, the annotations still come from the data folder
+    labeled_trainset = StoreLabeledDataset(store_folder=opt.sample_store,
+                                           annotation_file=annotation_csv,
+                                           scene_index=labeled_scene_index,
+                                           uint8=opt.uint8,
+                                           )
+else:
+    labeled_trainset = LabeledDataset(image_folder=image_folder,
+                                      annotation_file=annotation_csv,
+                                      scene_index=labeled_scene_index,
+                                      transform=transform,
+                                      extra_info=False,
+                                      decode_threads=decode_threads,
+                                      )
+
+collate_fn = yolo_collate_fn
+
+if opt.feature_cache is not None:
+    from feature_cache import load_feature_cache, feature_cache_collate_fn
+
+    labeled_trainset = load_feature_cache(kobe_model,
+                                          labeled_trainset,
+                                          opt.feature_cache,
+                                          fp16=opt.feature_cache_fp16,
+                                          device=device,
+                                          verbose=opt.verbose,
+                                          )
+    # the road maps and YOLO targets come from the cache too
+    collate_fn = feature_cache_collate_fn
+
+micro_batch_size = opt.batch_size
+accumulation_steps = opt.accumulation_steps
+effective_batch_size = micro_batch_size * accumulation_steps
+
+if opt.memory_budget_gb is not None:
+    if cuda:
+        raise ValueError('--memory_budget_gb measures the training memory on the cpu')
+
+    largest_micro_batch = auto_micro_batch_size(kobe_model,
+                                                opt.memory_budget_gb * 2 ** 30,
+                                                tuple(labeled_trainset[0][0].shape),
+                                                features=opt.feature_cache is not None,
+                                                max_batch_size=effective_batch_size)
+    # the largest divisor of the effective batch that fits, so that it stays the same.
+    # not below 2 with batch norm, like auto_micro_batch_size
+    smallest_micro_batch = smallest_micro_batch_size(kobe_model)
+    divisors = [size for size in range(smallest_micro_batch, largest_micro_batch + 1) if effective_batch_size % size == 0]
+    if not divisors:
+        raise ValueError(f'no micro-batch of {smallest_micro_batch} to {largest_micro_batch} samples divides the batch of '
+                         f'{effective_batch_size}, change --batch_size or --accumulation_steps')
+    micro_batch_size = max(divisors)
+    accumulation_steps = effective_batch_size // micro_batch_size
+
+print(f'Micro-batch {micro_batch_size} x {accumulation_steps} accumulation steps = batch {effective_batch_size}')
+
+# shuffles like shuffle=True, but an epoch can be resumed from any batch
+sampler = ResumableSampler(len(labeled_trainset), seed=opt.seed)
+steps_per_epoch = math.ceil(len(labeled_trainset) / effective_batch_size)
 
 trainloader = torch.utils.data.DataLoader(labeled_trainset,
-                                          batch_size=opt.batch_size,
-                                          shuffle=True,
-                                          num_workers=0,
+                                          batch_size=micro_batch_size,
+                                          sampler=sampler,
+                                          num_workers=opt.num_workers,
                                           collate_fn=collate_fn,
+                                          worker_init_fn=seed_worker,
+                                          persistent_workers=opt.num_workers > 0,
+                                          pin_memory=cuda,
                                           )
 
-for epoch in range(n_epochs):
-    print("EPOCH: {}".format(epoch))
-    train_yolo(trainloader,
-               kobe_model,
-               kobe_optimizer,
-               opt.verbose,
-               opt.prince,
-               )
-
-    torch.save(kobe_model.state_dict(),
-               f'{opt.filename}_{epoch}_epochs.pt')
-
-    try:
-        # keep the last 3 epochs and remove any previous ones
-        os.remove(f'{opt.filename}_{epoch - 3}_epochs.pt')
-    except FileNotFoundError:
-        pass
+# checkpoints are written in the background, training only waits for the copy to cpu memory
+# the checkpoints of an earlier run count towards keep_last too
+checkpoint_writer = CheckpointWriter(keep_last=opt.keep_last,
+                                     patterns={'step': f'{opt.filename}_{{}}_steps.pt',
+                                               'epoch': f'{opt.filename}_{{}}_epochs.pt',
+                                               'epoch_state': f'{opt.filename}_{{}}_epochs_state.pt',
+                                               })
+training_checkpointer = TrainingCheckpointer(checkpoint_writer,
+                                             kobe_model,
+                                             kobe_optimizer,
+                                             sampler)
+
+start_epoch, start_step = 0, 0
+if opt.resume is not None:
+    start_epoch, start_step = load_training_state(opt.resume, kobe_model, kobe_optimizer, sampler, map_location=device)
+    if start_step >= steps_per_epoch:
+        start_epoch, start_step = start_epoch + 1, 0
+    print(f'Resuming from epoch {start_epoch}, step {start_step}')
+
+def save_step(epoch, step):
+    # step is the number of optimizer steps done in the epoch
+    global_step = epoch * steps_per_epoch + step
+    if opt.save_every_steps > 0 and global_step % opt.save_every_steps == 0:
+        training_checkpointer.save(f'{opt.filename}_{global_step}_steps.pt', epoch, step, tag='step')
+
+with checkpoint_writer:
+    for epoch in range(start_epoch, n_epochs):
+        print("EPOCH: {}".format(epoch))
+
+        first_step = start_step if epoch == start_epoch else 0
+        sampler.set_epoch(epoch)
+        sampler.skip(first_step * effective_batch_size)
+
+        train_yolo(trainloader,
+                   kobe_model,
+                   kobe_optimizer,
+                   opt.verbose,
+                   opt.prince,
+                   features=opt.feature_cache is not None,
+                   step_callback=lambda i: save_step(epoch, first_step + i + 1),
+                   accumulation_steps=accumulation_steps,
+                   )
+
+        # keeps the last opt.keep_last epochs and removes any previous ones
+        checkpoint_writer.save(kobe_model.state_dict(),
+                               f'{opt.filename}_{epoch}_epochs.pt',
+                               tag='epoch')
+        training_checkpointer.save(f'{opt.filename}_{epoch}_epochs_state.pt', epoch, steps_per_epoch, tag='epoch_state')